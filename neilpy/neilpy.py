@@ -26,7 +26,15 @@ More interpolators
 #%%
 import os
 import inspect
+import time
+import tracemalloc
 import struct
+import datetime
+import glob
+import warnings
+import concurrent.futures
+import multiprocessing
+from multiprocessing import shared_memory
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
@@ -38,6 +46,7 @@ from scipy import linalg
 from scipy.signal import convolve2d
 from scipy.signal import fftconvolve
 from scipy import interpolate
+from scipy import spatial
 from PIL import Image
 from skimage.util import apply_parallel
 from skimage.morphology import disk
@@ -45,6 +54,19 @@ import cv2
 import imageio
 
 from pyproj import Transformer
+from pyproj import CRS
+
+# lazrs is only needed to read compressed (LAZ) point clouds
+try:
+    import lazrs
+except ImportError:
+    lazrs = None
+
+# pyamg is only needed for the multigrid inpainting solver
+try:
+    import pyamg
+except ImportError:
+    pyamg = None
 
 # Global variable to help load data files (PNG-based color tables, etc.)
 neilpy_dir = os.path.dirname(inspect.stack()[0][1])
@@ -69,24 +91,75 @@ def coord_transform(x,y,from_epsg,to_epsg):
 
 #%% Reading data - a handy wrapper to spare some pain
 
-def imread(fn, return_metadata=True, fix_nodata=False, force_float=False):
+'''
+Reads a raster into a numpy array, with a metadata dictionary (the rasterio
+profile, plus bounds and cellsize).  Single band rasters come back as 
+(rows,cols) arrays; multiband rasters as (rows,cols,bands).
+
+Only part of a large raster need be read:
+    window: a rasterio Window, or ((row_start,row_stop),(col_start,col_stop))
+    bounds: (left,bottom,right,top) in map units; the window is expanded 
+        outward to whole pixels
+    bands: a band number (giving a 2D array) or a list of band numbers 
+        (1-based, as in rasterio)
+    overview_level: read from one of the file's internal overviews (0 is 
+        the first, usually half resolution) rather than full resolution
+    out_shape: (rows,cols) to decimate (or replicate) to, using resampling
+        (a rasterio Resampling name, e.g. 'nearest', 'average', 'bilinear')
+        GDAL will use overviews to satisfy this where it can.
+
+The transform, width, height, count and bounds in the metadata describe the
+array actually returned.
 
-    with rasterio.open(fn) as src:
+Examples:
+    Z, metadata = neilpy.imread('dem.tif',bounds=(512000,5403000,513000,5404000))
+    RGB, metadata = neilpy.imread('ortho.tif',bands=[1,2,3],out_shape=(1000,1000))
+'''
+
+def imread(fn, return_metadata=True, fix_nodata=False, force_float=False,
+           window=None, bounds=None, bands=None, overview_level=None,
+           out_shape=None, resampling='nearest'):
+
+    with rasterio.open(fn, overview_level=overview_level) as src:
         metadata = src.profile
-        #metadata['count'] = src.count
-        #metadata['crs'] = src.crs
-        #metadata['transform'] = src.transform
-        metadata['bounds'] = src.bounds
-        #metadata['width'] = src.width
-        #metadata['height'] = src.height
-        metadata['dtype'] = src.dtypes[0]  # This returns an array.  Safe to assume all the same?
-        #metadata['nodata_value'] = src.nodatavals[0]
         
+        # Work out which part of the raster to read
+        full_window = rasterio.windows.Window(0,0,src.width,src.height)
+        if bounds is not None:
+            window = rasterio.windows.from_bounds(*bounds,transform=src.transform)
+            window = rasterio.windows.Window.from_slices(
+                (int(np.floor(window.row_off)),int(np.ceil(window.row_off+window.height))),
+                (int(np.floor(window.col_off)),int(np.ceil(window.col_off+window.width))))
+        if window is None:
+            window = full_window
+        elif not isinstance(window,rasterio.windows.Window):
+            window = rasterio.windows.Window.from_slices(*window)
+        window = window.intersection(full_window)
         
-        if src.count > 1:
-            X = np.stack([src.read(i+1) for i in range(src.count)],axis=2)
-        else:
-            X = src.read(1)
+        if bands is None:
+            bands = list(range(1,src.count+1))
+        squeeze = np.isscalar(bands) or len(bands)==1
+        bands = list(np.atleast_1d(bands))
+        
+        if out_shape is None:
+            out_shape = (int(window.height),int(window.width))
+        transform = src.window_transform(window)
+        transform = transform * rasterio.Affine.scale(window.width / out_shape[1],
+                                                      window.height / out_shape[0])
+        
+        metadata['dtype'] = src.dtypes[bands[0]-1]
+        metadata['count'] = len(bands)
+        metadata['height'],metadata['width'] = out_shape
+        metadata['transform'] = transform
+        metadata['bounds'] = rasterio.coords.BoundingBox(*rasterio.transform.array_bounds(out_shape[0],out_shape[1],transform))
+        
+        # Read each band directly into its slot of a band-interleaved array
+        resampling = rasterio.enums.Resampling[resampling]
+        X = np.empty((out_shape[0],out_shape[1],len(bands)),dtype=metadata['dtype'])
+        for i,band in enumerate(bands):
+            src.read(int(band),window=window,out=X[:,:,i],resampling=resampling)
+        if squeeze:
+            X = X[:,:,0]
     
     # If asked to force into float, and not already in float, convert.
     if force_float and metadata['dtype'] not in ['float32','float64']:
@@ -118,16 +191,173 @@ def imread(fn, return_metadata=True, fix_nodata=False, force_float=False):
     
 #%%
 
-# TODO: check # bands, and write these out properly; 
-#       ATM, geospatial write out only supported for a single layer
-# TODO: support writing of indexed /colormapped data
+'''
+Writes an image.  Without metadata, this is a plain image write through
+imageio.  With metadata (a rasterio profile, such as from imread), the array
+is written as a GeoTIFF:
+    im may be (rows, cols) or (rows, cols, bands), as returned by imread.
+    colormap, for single band 8 or 16 bit data, is embedded as a palette; it
+        may be a dict of value:(r,g,b[,a]) or a flat [r,g,b,r,g,b,...] list 
+        such as geomorphon_cmap().
+    compress is the GDAL compression ('deflate', 'lzw', 'zstd', ...), with the
+        matching predictor (2 for integers, 3 for floats), or None for none.
+    tiled writes internal tiles of blocksize x blocksize pixels.
+    overviews is a list of decimation factors (e.g. [2,4,8,16]), or True to
+        halve until the image fits within a tile.  overview_resampling 
+        defaults to nearest for integers and average for floats.
+    window writes im into that part of an existing raster (opened in r+ 
+        mode), as a rasterio Window or ((row_start,row_stop),(col_start,col_stop)),
+        for pairing with raster_blocks; metadata is then not needed.
+
+Examples:
+    neilpy.imwrite('hillshade.tif',H,metadata)
+    neilpy.imwrite('geomorphons.tif',G,metadata,colormap=neilpy.geomorphon_cmap(),overviews=True)
+'''
 
-def imwrite(fn,im,metadata=None):
-    if metadata is None:
+def imwrite(fn,im,metadata=None,colormap=None,compress='deflate',tiled=True,
+            blocksize=256,overviews=None,overview_resampling=None,window=None):
+    if window is not None:
+        if not isinstance(window,rasterio.windows.Window):
+            window = rasterio.windows.Window.from_slices(*window)
+        with rasterio.open(fn,'r+') as dst:
+            dst.write(_band_first(im),window=window)
+    elif metadata is None:
         imageio.imwrite(fn,im)
     else:
-        with rasterio.open(fn, 'w', **metadata) as dst:
-            dst.write(im, 1) 
+        im = _band_first(im)
+        profile = _geotiff_profile(metadata,im.dtype,im.shape[0],compress,tiled,blocksize)
+        profile['height'],profile['width'] = im.shape[1:]
+        with rasterio.open(fn,'w',**profile) as dst:
+            dst.write(im)
+            if colormap is not None:
+                dst.write_colormap(1,_colormap_dict(colormap))
+            _build_overviews(dst,overviews,overview_resampling,blocksize)
+
+
+# Returns a (bands, rows, cols) view of a 2D or bands-last 3D array, as 
+# rasterio expects
+def _band_first(im):
+    im = np.asarray(im)
+    if im.ndim==2:
+        return im[np.newaxis,:,:]
+    return np.moveaxis(im,2,0)
+
+
+# Builds a GeoTIFF profile from metadata (imread adds cellsize and bounds,
+# which are not creation options)
+def _geotiff_profile(metadata,dtype,count,compress='deflate',tiled=True,blocksize=256):
+    profile = {k:v for k,v in dict(metadata).items() if k not in ['cellsize','bounds',
+               'compress','predictor','tiled','blockxsize','blockysize','interleave']}
+    profile.update(driver='GTiff',dtype=np.dtype(dtype).name,count=count)
+    if count>1:
+        profile['interleave'] = 'pixel'
+    if tiled:
+        profile.update(tiled=True,blockxsize=blocksize,blockysize=blocksize)
+    if compress is not None:
+        profile['compress'] = compress
+        if compress.lower() in ['deflate','lzw','zstd']:
+            profile['predictor'] = 3 if np.issubdtype(dtype,np.floating) else 2
+    return profile
+
+
+def _colormap_dict(colormap):
+    if isinstance(colormap,dict):
+        return colormap
+    colormap = np.reshape(colormap,(-1,3))
+    return {i:tuple(int(v) for v in rgb) for i,rgb in enumerate(colormap)}
+
+
+def _build_overviews(dst,overviews=None,resampling=None,blocksize=256):
+    if overviews is None or overviews is False:
+        return
+    if overviews is True:
+        overviews = []
+        factor = 2
+        while max(dst.height,dst.width) / factor >= blocksize / 2:
+            overviews.append(factor)
+            factor *= 2
+    if not len(overviews):
+        return
+    if resampling is None:
+        resampling = 'average' if np.issubdtype(dst.dtypes[0],np.floating) else 'nearest'
+    dst.build_overviews(list(overviews),rasterio.enums.Resampling[resampling])
+    dst.update_tags(ns='rio_overview',resampling=resampling)
+
+
+#%% Block processing for rasters too large to hold in memory
+
+'''
+Iterates over a raster in square blocks of block_size pixels, each read 
+with a halo of extra pixels on every side (clipped at the raster edges).
+For each block this yields:
+    X: the block plus its halo, as returned by imread
+    metadata: as from imread, describing X
+    window: the rasterio Window of the block itself (without halo)
+    interior: a tuple of slices selecting the block from X
+
+A neighborhood operator applied to X gives the same values in X[interior]
+as it would on the whole raster, provided the halo is at least as wide as
+the operator's reach: 1 for slope, aspect, hillshade and the curvatures, 
+lookup_pixels for openness and geomorphons, radius for 
+topographic_position_index (with standardize=False, as standardizing uses
+whole-raster statistics).  Blocks at the raster edge see the same edge as
+the whole raster would.
+
+Remaining arguments are passed on to imread.
+'''
+
+def raster_blocks(fn,block_size=1024,halo=0,bands=1,fix_nodata=False,force_float=False):
+    with rasterio.open(fn) as src:
+        height,width = src.height,src.width
+    for row in range(0,height,block_size):
+        for col in range(0,width,block_size):
+            window = rasterio.windows.Window(col,row,min(block_size,width-col),
+                                             min(block_size,height-row))
+            r0,c0 = max(row-halo,0),max(col-halo,0)
+            r1 = min(row+block_size+halo,height)
+            c1 = min(col+block_size+halo,width)
+            X,metadata = imread(fn,window=((r0,r1),(c0,c1)),bands=bands,
+                                fix_nodata=fix_nodata,force_float=force_float)
+            interior = (slice(row-r0,row-r0+int(window.height)),
+                        slice(col-c0,col-c0+int(window.width)))
+            yield X,metadata,window,interior
+
+
+'''
+Applies a function to a raster block by block, writing the result to a new
+GeoTIFF, so that the terrain functions here can be run on rasters many 
+times larger than memory.  func is called on each block (with halo) as 
+func(X,**kwargs), and must return an array of the same rows and columns 
+(2D, or 3D with bands last).  Only the interior of each result is written,
+so with a sufficient halo (see raster_blocks) the output is identical to 
+calling func on the whole raster.
+
+Example:
+    neilpy.apply_blocks(neilpy.openness,'dem.tif','openness.tif',halo=50,
+                        cellsize=30,lookup_pixels=50)
+'''
+
+def apply_blocks(func,fn,out_fn,block_size=1024,halo=0,bands=1,nodata=None,
+                 fix_nodata=False,force_float=False,compress='deflate',
+                 overviews=None,**kwargs):
+    dst = None
+    try:
+        for X,metadata,window,interior in raster_blocks(fn,block_size,halo,bands,
+                                                        fix_nodata,force_float):
+            result = _band_first(func(X,**kwargs)[interior])
+            
+            # The output is created once the type of the result is known
+            if dst is None:
+                with rasterio.open(fn) as src:
+                    profile = _geotiff_profile(src.profile,result.dtype,result.shape[0],compress)
+                profile['nodata'] = nodata
+                dst = rasterio.open(out_fn,'w',**profile)
+            dst.write(result,window=window)
+        if dst is not None:
+            _build_overviews(dst,overviews)
+    finally:
+        if dst is not None:
+            dst.close()
 
 
 #%% Spatial Autocorrelation Functions
@@ -489,19 +719,66 @@ LAZ http://howardbutler.com/javascript-laz-implementation.html
 http://www.asprs.org/wp-content/uploads/2019/07/LAS_1_4_r15.pdf
 """
 
-# Reads a file into pandas dataframe
-# Originally developed as research/current/lidar/bonemap
-# A pure python las reader
-def read_las(filename):
-
-    with open(filename,mode='rb') as file:
-        data = file.read()
-    
-    # This dictionary holds the byte length of the point data (see minimum
-    # PDRF Size given in LAS spec.)
-    point_data_format_key = {0:20,1:28,2:26,3:34,4:57,5:63,6:30,7:36,8:38,9:59,10:67}
-    
-    # Read header into a dictionary
+# The byte layout of each Point Data Record Format (see LAS spec.).  Bit
+# fields (return_byte, mixed_byte) are kept packed here and unpacked on 
+# demand by las_column.
+las_point_formats = {}
+las_point_formats[0] = [('x', 'i4'), ('y', 'i4'), ('z', 'i4'), ('intensity', 'u2'),
+                        ('return_byte','u1'),('class','u1'),('scan_angle','u1'),
+                        ('user_data','u1'),('point_source_id','u2')]
+las_point_formats[1] = las_point_formats[0] + [('gpstime','f8')]
+las_point_formats[2] = las_point_formats[0] + [('red','u2'),('green','u2'),('blue','u2')]
+las_point_formats[3] = las_point_formats[1] + [('red','u2'),('green','u2'),('blue','u2')]
+las_wave_fields = [('wave_packet_descriptor_index','u1'),('byte_offset','u8'),
+                   ('wave_packet_size','u4'),('return_point_waveform_location','f4'),
+                   ('xt','f4'),('yt','f4'),('zt','f4')]
+las_point_formats[4] = las_point_formats[1] + las_wave_fields
+las_point_formats[5] = las_point_formats[3] + las_wave_fields
+las_point_formats[6] = [('x', 'i4'), ('y', 'i4'), ('z', 'i4'), ('intensity', 'u2'),
+                        ('return_byte','u1'),('mixed_byte','u1'),('class','u1'),
+                        ('user_data','u1'),('scan_angle','u2'),('point_source_id','u2'),
+                        ('gpstime','f8')]
+las_point_formats[7] = las_point_formats[6] + [('red','u2'),('green','u2'),('blue','u2')]
+las_point_formats[8] = las_point_formats[7] + [('near_infrared','u2')]
+las_point_formats[9] = las_point_formats[6] + las_wave_fields
+las_point_formats[10] = las_point_formats[8] + las_wave_fields
+
+# Bit fields packed into the return and mixed bytes, as (byte, first bit, 
+# number of bits).  Single bit fields are returned as booleans.
+las_legacy_bit_fields = {'return_number':('return_byte',0,3),
+                         'return_max':('return_byte',3,3),
+                         'scan_direction':('return_byte',6,1),
+                         'edge_of_flight_line':('return_byte',7,1)}
+las_extended_bit_fields = {'return_number':('return_byte',0,4),
+                           'return_max':('return_byte',4,4),
+                           'classification_bit_synthetic':('mixed_byte',0,1),
+                           'classification_bit_keypoint':('mixed_byte',1,1),
+                           'classification_bit_withheld':('mixed_byte',2,1),
+                           'classification_bit_overlap':('mixed_byte',3,1),
+                           'scanner_channel':('mixed_byte',4,2),
+                           'scan_direction':('mixed_byte',6,1),
+                           'edge_of_flight_line':('mixed_byte',7,1)}
+
+
+# Returns a numpy structured dtype for a point data record format.  If the 
+# record length in the header is longer than the format's minimum (i.e., the
+# file carries "extra bytes"), the dtype is padded so records line up.
+def las_point_dtype(point_data_format_id,point_data_record_length=None):
+    try:
+        dt = np.dtype(las_point_formats[point_data_format_id])
+    except KeyError:
+        raise ValueError('Point Data Record Format',point_data_format_id,'not yet supported.')
+    if point_data_record_length is not None and point_data_record_length > dt.itemsize:
+        dt = np.dtype({'names':dt.names,
+                       'formats':[dt.fields[name][0] for name in dt.names],
+                       'offsets':[dt.fields[name][1] for name in dt.names],
+                       'itemsize':point_data_record_length})
+    return dt
+
+
+# Parses the public header block from a buffer holding (at least) the first
+# header_size bytes of the file.
+def parse_las_header(data):
     header = {}
     header['file_signature'] = struct.unpack('<4s',data[0:4])[0].decode('utf-8')
     header['file_source_id'] = struct.unpack('<H',data[4:6])[0]
@@ -525,195 +802,1071 @@ def read_las(filename):
     header['point_data_offset'] = struct.unpack('<L',data[96:100])[0]
     header['num_variable_records'] = struct.unpack('<L',data[100:104])[0]
     header['point_data_format_id'] = struct.unpack('<B',data[104:105])[0]
-    laz_format = False
-    if header['point_data_format_id'] >= 128 and header['point_data_format_id'] <= 133:
-        laz_format = True
-        header['point_data_format_id'] = point_data_format_id - 128
-    if laz_format:
-        raise ValueError('LAZ not yet supported.')
-    try:
-        format_length = point_data_format_key[header['point_data_format_id']]
-    except:
+    # LAZ files flag compression by setting the high bit of the format id
+    # (bit 6 is reserved, and signals something else entirely)
+    header['compressed'] = False
+    if header['point_data_format_id'] & 128 and not header['point_data_format_id'] & 64:
+        header['compressed'] = True
+        header['point_data_format_id'] = header['point_data_format_id'] & 63
+    if header['point_data_format_id'] not in las_point_formats:
         raise ValueError('Point Data Record Format',header['point_data_format_id'],'not yet supported.')
     if header['point_data_format_id'] >= 6:
-        print('Point Data Formats 6-10 have recently been added to this reader.  Please check results carefully and report any suspected errors.')
+        # A warning (shown once, by default) rather than a print, as every 
+        # header of a catalog passes through here
+        warnings.warn('Point Data Formats 6-10 have recently been added to this reader.  Please check results carefully and report any suspected errors.',stacklevel=2)
     header['point_data_record_length'] = struct.unpack('<H',data[105:107])[0]
     header['num_point_records'] = struct.unpack('<L',data[107:111])[0]
     header['num_points_by_return'] = struct.unpack('<5L',data[111:131])
     header['scale'] = struct.unpack('<3d',data[131:155])
     header['offset'] = struct.unpack('<3d',data[155:179])
     header['minmax'] = struct.unpack('<6d',data[179:227]) #xmax,xmin,ymax,ymin,zmax,zmin
-    end_point_data = len(data)
     
     # For version 1.3, read in the location of the point data.  At this time
     # no wave information will be read
-    header_length = 227
-    if header['version']==1.3:
+    if header['version']>=1.3:
         header['begin_wave_form'] = struct.unpack('<q',data[227:235])[0]
-        header_length = 235
-        if header['begin_wave_form'] != 0:
-            end_point_data = header['begin_wave_form']
-
-    # Pare out only the point data
-    data = data[header['point_data_offset']:end_point_data]
-
-    if header['point_data_format_id']==1:
-        dt = np.dtype([('x', 'i4'), ('y', 'i4'), ('z', 'i4'), ('intensity', 'u2'),
-                       ('return_byte','u1'),('class','u1'),('scan_angle','u1'),
-                       ('user_data','u1'),('point_source_id','u2'),('gpstime','f8')])
-    
-    elif header['point_data_format_id']==2:
-        dt = np.dtype([('x', 'i4'), ('y', 'i4'), ('z', 'i4'), ('intensity', 'u2'),
-                       ('return_byte','u1'),('class','u1'),('scan_angle','u1'),
-                       ('user_data','u1'),('point_source_id','u2'),('red','u2'),
-                       ('green','u2'),('blue','u2')])
-    elif header['point_data_format_id']==3:
-        dt = np.dtype([('x', 'i4'), ('y', 'i4'), ('z', 'i4'), ('intensity', 'u2'),
-                       ('return_byte','u1'),('class','u1'),('scan_angle','u1'),
-                       ('user_data','u1'),('point_source_id','u2'),('gpstime','f8'),
-                       ('red','u2'),('green','u2'),('blue','u2')])
-    elif header['point_data_format_id']==4:
-        dt = np.dtype([('x', 'i4'), ('y', 'i4'), ('z', 'i4'), ('intensity', 'u2'),
-                       ('return_byte','u1'),('class','u1'),('scan_angle','u1'),
-                       ('user_data','u1'),('point_source_id','u2'),('gpstime','f8'),
-                       ('wave_packet_descriptor_index','u1'),('byte_offset','u8'),
-                       ('wave_packet_size','u4'),('return_point_waveform_location','f4'),
-                       ('xt','f4'),('yt','f4'),('zt','f4')])
-    elif header['point_data_format_id']==5:
-        dt = np.dtype([('x', 'i4'), ('y', 'i4'), ('z', 'i4'), ('intensity', 'u2'),
-                       ('return_byte','u1'),('class','u1'),('scan_angle','u1'),
-                       ('user_data','u1'),('point_source_id','u2'),('gpstime','f8'),
-                       ('red','u2'),('green','u2'),('blue','u2'),
-                       ('wave_packet_descriptor_index','u1'),('byte_offset','u8'),
-                       ('wave_packet_size','u4'),('return_point_waveform_location','f4'),
-                       ('xt','f4'),('yt','f4'),('zt','f4')])
-    elif header['point_data_format_id']==6:
-        dt = np.dtype([('x', 'i4'), ('y', 'i4'), ('z', 'i4'), ('intensity', 'u2'),
-                       ('return_byte','u1'),('mixed_byte','u1'),('class','u1'),
-                       ('user_data','u1'),('scan_angle','u2'),('point_source_id','u2'),
-                       ('gpstime','f8')])
-    elif header['point_data_format_id']==7:
-        dt = np.dtype([('x', 'i4'), ('y', 'i4'), ('z', 'i4'), ('intensity', 'u2'),
-                       ('return_byte','u1'),('mixed_byte','u1'),('class','u1'),
-                       ('user_data','u1'),('scan_angle','u2'),('point_source_id','u2'),
-                       ('gpstime','f8'),('red','u2'),('green','u2'),('blue','u2')])        
-    elif header['point_data_format_id']==8:
-        dt = np.dtype([('x', 'i4'), ('y', 'i4'), ('z', 'i4'), ('intensity', 'u2'),
-                       ('return_byte','u1'),('mixed_byte','u1'),('class','u1'),
-                       ('user_data','u1'),('scan_angle','u2'),('point_source_id','u2'),
-                       ('gpstime','f8'),('red','u2'),('green','u2'),('blue','u2'),
-                       ('near_infrared','u2')])    
-    elif header['point_data_format_id']==9:
-        dt = np.dtype([('x', 'i4'), ('y', 'i4'), ('z', 'i4'), ('intensity', 'u2'),
-                       ('return_byte','u1'),('mixed_byte','u1'),('class','u1'),
-                       ('user_data','u1'),('scan_angle','u2'),('point_source_id','u2'),
-                       ('gpstime','f8'),('wave_packet_descriptor_index','u1'),
-                       ('byte_offset','u8'),('wave_packet_size','u4'),
-                       ('return_point_waveform_location','f4'),
-                       ('xt','f4'),('yt','f4'),('zt','f4')])
-    elif header['point_data_format_id']==10:
-        dt = np.dtype([('x', 'i4'), ('y', 'i4'), ('z', 'i4'), ('intensity', 'u2'),
-                       ('return_byte','u1'),('mixed_byte','u1'),('class','u1'),
-                       ('user_data','u1'),('scan_angle','u2'),('point_source_id','u2'),
-                       ('gpstime','f8'),('red','u2'),('green','u2'),('blue','u2'),
-                       ('near_infrared','u2'),('wave_packet_descriptor_index','u1'),
-                       ('byte_offset','u8'),('wave_packet_size','u4'),
-                       ('return_point_waveform_location','f4'),
-                       ('xt','f4'),('yt','f4'),('zt','f4')])         
-        
-        
-    # Transform to Pandas dataframe, via a numpy array
-    data = pd.DataFrame(np.frombuffer(data,dt))
-    data['x'] = data['x']*header['scale'][0] + header['offset'][0]
-    data['y'] = data['y']*header['scale'][1] + header['offset'][1]
-    data['z'] = data['z']*header['scale'][2] + header['offset'][2]
 
-    def get_bit(byteval,idx):
-        return ((byteval&(1<<idx))!=0);
+    # Version 1.4 adds extended variable length records (EVLRs) after the 
+    # point data, and 64 bit point counts.  The legacy counts are zero for
+    # formats 6-10 and for files with more than 2^32 points, so the 64 bit
+    # counts are used whenever they are given.
+    if header['version']>=1.4:
+        header['start_of_first_evlr'] = struct.unpack('<Q',data[235:243])[0]
+        header['num_evlrs'] = struct.unpack('<L',data[243:247])[0]
+        num_point_records = struct.unpack('<Q',data[247:255])[0]
+        num_points_by_return = struct.unpack('<15Q',data[255:375])
+        if num_point_records > 0:
+            header['num_point_records'] = num_point_records
+            header['num_points_by_return'] = num_points_by_return
+    return header
+
+
+# Reads the variable length records that sit between the header and the
+# point data.  Each is returned as a dictionary, with the payload as bytes.
+def read_las_vlrs(file,header):
+    file.seek(header['header_size'])
+    vlrs = []
+    for i in range(header['num_variable_records']):
+        data = file.read(54)
+        vlr = {}
+        vlr['user_id'] = struct.unpack('16s',data[2:18])[0].decode('utf-8','replace').rstrip('\x00')
+        vlr['record_id'] = struct.unpack('<H',data[18:20])[0]
+        record_length = struct.unpack('<H',data[20:22])[0]
+        vlr['description'] = struct.unpack('32s',data[22:54])[0].decode('utf-8','replace').rstrip('\x00')
+        vlr['data'] = file.read(record_length)
+        vlrs.append(vlr)
+    return vlrs
+
+
+# Reads the extended variable length records at the end of a 1.4 file
+def read_las_evlrs(file,header):
+    file.seek(header['start_of_first_evlr'])
+    evlrs = []
+    for i in range(header['num_evlrs']):
+        data = file.read(60)
+        evlr = {}
+        evlr['user_id'] = struct.unpack('16s',data[2:18])[0].decode('utf-8','replace').rstrip('\x00')
+        evlr['record_id'] = struct.unpack('<H',data[18:20])[0]
+        record_length = struct.unpack('<Q',data[20:28])[0]
+        evlr['description'] = struct.unpack('32s',data[28:60])[0].decode('utf-8','replace').rstrip('\x00')
+        evlr['data'] = file.read(record_length)
+        evlrs.append(evlr)
+    return evlrs
+
+
+# Pulls the coordinate reference system out of the LASF_Projection records:
+# the OGC WKT string if there is one, and the GeoTIFF keys, from which an
+# EPSG code is taken (projected if given, else geographic, else whatever 
+# pyproj can identify from the WKT).
+def parse_las_crs(vlrs):
+    crs = {'crs_wkt':None,'geokeys':{},'epsg':None}
+    for vlr in vlrs:
+        if vlr['user_id'] != 'LASF_Projection':
+            continue
+        if vlr['record_id']==2112:
+            crs['crs_wkt'] = vlr['data'].decode('utf-8','replace').rstrip('\x00')
+        elif vlr['record_id']==34735 and len(vlr['data']) >= 8:
+            keys = np.frombuffer(vlr['data'],dtype='<u2')
+            num_keys = keys[3]
+            for key_id,location,count,value in keys[4:4+4*num_keys].reshape((-1,4)):
+                # Only values stored directly in the directory are kept
+                if location==0:
+                    crs['geokeys'][int(key_id)] = int(value)
+    for key_id in [3072,2048]:  # ProjectedCSTypeGeoKey, GeographicTypeGeoKey
+        if crs['geokeys'].get(key_id,32767) not in [0,32767]:
+            crs['epsg'] = crs['geokeys'][key_id]
+            break
+    if crs['epsg'] is None and crs['crs_wkt']:
+        try:
+            crs['epsg'] = CRS.from_wkt(crs['crs_wkt']).to_epsg()
+        except Exception:
+            pass
+    return crs
+
+
+# Reads only the header of a las or laz file: the public header block, the
+# variable length records, and (for 1.4 files) the extended variable length
+# records, without touching the point data.  The coordinate reference 
+# system is added as crs_wkt, geokeys and epsg (see parse_las_crs).  This 
+# is the fast way to inventory point counts, bounds and CRS for many files.
+def read_las_header(filename):
+    with open(filename,mode='rb') as file:
+        header = parse_las_header(file.read(375))
+        header['vlrs'] = read_las_vlrs(file,header)
+        header['evlrs'] = []
+        if header.get('num_evlrs',0) > 0 and header['start_of_first_evlr'] > 0:
+            header['evlrs'] = read_las_evlrs(file,header)
+    header.update(parse_las_crs(header['vlrs'] + header['evlrs']))
+    return header
+
+
+# Returns the header and the number of point records actually present in 
+# the file (waveform data in 1.3 files, and EVLRs in 1.4 files, follow the
+# points).
+def _read_las_header_and_count(filename):
+    header = read_las_header(filename)
+    if header['compressed']:
+        return header,header['num_point_records']
+    end_point_data = os.path.getsize(filename)
+    if header.get('begin_wave_form',0) != 0:
+        end_point_data = header['begin_wave_form']
+    if header.get('start_of_first_evlr',0) != 0:
+        end_point_data = min(end_point_data,header['start_of_first_evlr'])
+    n = (end_point_data - header['point_data_offset']) // header['point_data_record_length']
+    if header['num_point_records'] > 0:
+        n = min(n,header['num_point_records'])
+    return header,n
+
+
+# Positions an open LAZ file at its point data and returns a lazrs
+# decompressor for it.  The parallel decompressor spreads each request over
+# the LAZ chunk table, decoding whole chunks on separate threads.
+def _las_decompressor(file,header):
+    if lazrs is None:
+        raise ImportError('Reading LAZ files requires the lazrs package.')
+    laszip_vlrs = [vlr for vlr in header['vlrs'] 
+                   if vlr['user_id']=='laszip encoded' and vlr['record_id']==22204]
+    if len(laszip_vlrs)==0:
+        raise ValueError('LAZ file has no laszip VLR.')
+    file.seek(header['point_data_offset'])
+    return lazrs.ParLasZipDecompressor(file,laszip_vlrs[0]['data'])
+
+
+# Decompresses the next count points into raw records of dtype dt
+def _decompress_las_points(decompressor,dt,count):
+    points = np.empty(count,dtype=dt)
+    if count > 0:
+        decompressor.decompress_many(points.view(np.uint8))
+    return points
 
-    # Recast the mixed bytes as specified in the LAS specification
-    if header['point_data_format_id'] < 6:
-        data['return_number'] = 4 * get_bit(data['return_byte'],2).astype(np.uint8) + 2 * get_bit(data['return_byte'],1).astype(np.uint8) + get_bit(data['return_byte'],0).astype(np.uint8)
-        data['return_max'] = 4 * get_bit(data['return_byte'],5).astype(np.uint8) + 2 * get_bit(data['return_byte'],4).astype(np.uint8) + get_bit(data['return_byte'],3).astype(np.uint8)
-        data['scan_direction'] = get_bit(data['return_byte'],6)
-        data['edge_of_flight_line'] = get_bit(data['return_byte'],7)
-        del data['return_byte']
+
+# Reads a file into pandas dataframe
+# Originally developed as research/current/lidar/bonemap
+# A pure python las reader
+#
+# With memory_map=True, the point records are not read at all; instead a 
+# read-only structured numpy view over the mapped file is returned (raw 
+# integer coordinates and packed bit fields), and columns can be decoded as
+# needed with las_column or las_dataframe.  LAZ files cannot be mapped, so 
+# for those the raw records are decompressed into memory instead (in chunks,
+# keeping only the selected points, when filtering):
+#
+#   header, points = read_las('big.las',memory_map=True)
+#   z = las_column(header,points,'z')
+#   df = las_dataframe(header,points,columns=['x','y','z','class'])
+#
+# columns restricts the dataframe to the named columns (see las_columns), 
+# and classification, return_number and bbox select points before anything
+# is decoded (see las_filter).  When filtering, the index of the dataframe
+# holds the record numbers of the selected points in the file.
+#
+#   header, df = read_las('big.las',columns=['x','y','z'],classification=[2])
+def read_las(filename,memory_map=False,columns=None,classification=None,
+             return_number=None,bbox=None):
+
+    header,n = _read_las_header_and_count(filename)
+    dt = las_point_dtype(header['point_data_format_id'],header['point_data_record_length'])
+    filtered = classification is not None or return_number is not None or bbox is not None
+
+    if n == 0:
+        points = np.zeros(0,dtype=dt)
+    elif header['compressed'] and filtered:
+        # Filter each chunk as it is decompressed, so that only the selected
+        # points are held in memory
+        points,idx = [],[]
+        with open(filename,mode='rb') as file:
+            decompressor = _las_decompressor(file,header)
+            for start in range(0,n,1000000):
+                chunk = _decompress_las_points(decompressor,dt,min(1000000,n-start))
+                keep = np.flatnonzero(las_filter(header,chunk,classification,return_number,bbox))
+                points.append(chunk[keep])
+                idx.append(start + keep)
+                del chunk
+        points,idx = np.concatenate(points),np.concatenate(idx)
+    elif header['compressed']:
+        with open(filename,mode='rb') as file:
+            points = _decompress_las_points(_las_decompressor(file,header),dt,n)
+    elif memory_map or filtered:
+        points = np.memmap(filename,dtype=dt,mode='r',
+                           offset=header['point_data_offset'],shape=(n,))
     else:
-        data['return_number'] = 8 * get_bit(data['return_byte'],3).astype(np.uint8) + 4 * get_bit(data['return_byte'],2).astype(np.uint8) + 2 * get_bit(data['return_byte'],1).astype(np.uint8) + get_bit(data['return_byte'],0).astype(np.uint8)
-        data['return_max'] = 8 * get_bit(data['return_byte'],7).astype(np.uint8) + 4 * get_bit(data['return_byte'],6).astype(np.uint8) + 2 * get_bit(data['return_byte'],5).astype(np.uint8) + get_bit(data['return_byte'],4).astype(np.uint8)
-        # data['scan_direction'] = get_bit(data['return_byte'],6)
-        # data['edge_of_flight_line'] = get_bit(data['return_byte'],7)
-        del data['return_byte']        
-    if header['point_data_format_id'] >= 6:
-        data['classification_bit_synthetic'] = get_bit(data['mixed_byte'],0)
-        data['classification_bit_keypoint'] = get_bit(data['mixed_byte'],1)
-        data['classification_bit_withheld'] = get_bit(data['mixed_byte'],2)
-        data['classification_bit_overlap'] = get_bit(data['mixed_byte'],3)
-        data['scanner_channel'] = 2 * get_bit(data['mixed_byte'],5).astype(np.uint8) + 1 * get_bit(data['mixed_byte'],4).astype(np.uint8)
-        data['scan_direction'] = get_bit(data['mixed_byte'],6)
-        data['edge_of_flight_line'] = get_bit(data['mixed_byte'],7)
-        del data['mixed_byte']
+        # Read only the point block, in a single pass
+        points = np.fromfile(filename,dtype=dt,count=n,offset=header['point_data_offset'])
     
+    # Evaluate filters on the mapped records, so that only the selected 
+    # points are ever copied into memory.
+    if filtered and (n == 0 or not header['compressed']):
+        idx = np.flatnonzero(las_filter(header,points,classification,return_number,bbox))
+        points = points[idx]
 
+    if memory_map:
+        return header,points
+    
+    data = las_dataframe(header,points,columns)
+    if filtered:
+        data.index = idx
     
     return header,data
 
+
+# Iterates over a las file in bounded memory.  The header is yielded first,
+# followed by dataframes of at most chunk_size points with the same columns
+# as read_las.  The index of each chunk continues from the last, so the
+# chunks can be concatenated back into the result of read_las.
+#
+#   chunks = iter_las('big.las',chunk_size=1000000)
+#   header = next(chunks)
+#   for df in chunks:
+#       ...
+#
+# The columns and filter arguments are as in read_las; filters are applied
+# to each chunk before decoding, so chunks may hold fewer points (or none).
+def iter_las(filename,chunk_size=1000000,columns=None,classification=None,
+             return_number=None,bbox=None):
+
+    header,n = _read_las_header_and_count(filename)
+    dt = las_point_dtype(header['point_data_format_id'],header['point_data_record_length'])
+    filtered = classification is not None or return_number is not None or bbox is not None
+    yield header
+
+    with open(filename,mode='rb') as file:
+        if header['compressed']:
+            decompressor = _las_decompressor(file,header)
+        else:
+            file.seek(header['point_data_offset'])
+        for start in range(0,n,chunk_size):
+            if header['compressed']:
+                points = _decompress_las_points(decompressor,dt,min(chunk_size,n-start))
+            else:
+                points = np.fromfile(file,dtype=dt,count=min(chunk_size,n-start))
+            if filtered:
+                idx = np.flatnonzero(las_filter(header,points,classification,return_number,bbox))
+                data = las_dataframe(header,points[idx],columns)
+                data.index = start + idx
+            else:
+                data = las_dataframe(header,points,columns)
+                data.index = pd.RangeIndex(start,start+len(points))
+            yield data
+
+
+# Decodes a single named column from raw point records (e.g., a memory 
+# mapped view from read_las).  Coordinates are scaled and offset, and the 
+# bit fields packed in return_byte and mixed_byte are unpacked; any other 
+# field is returned as stored.
+def las_column(header,points,name):
+    if name in ['x','y','z']:
+        i = 'xyz'.index(name)
+        return points[name]*header['scale'][i] + header['offset'][i]
+    if header['point_data_format_id'] < 6:
+        bit_fields = las_legacy_bit_fields
+    else:
+        bit_fields = las_extended_bit_fields
+    if name in bit_fields:
+        byte_name,first_bit,num_bits = bit_fields[name]
+        value = (points[byte_name] >> first_bit) & ((1 << num_bits) - 1)
+        if num_bits==1:
+            return value != 0
+        return value.astype(np.uint8)
+    if name not in points.dtype.names:
+        raise ValueError('Column',name,'is not available in Point Data Record Format',header['point_data_format_id'])
+    return np.array(points[name])
+
+
+# Returns a boolean mask over raw point records, evaluated on the stored 
+# integers without scaling or unpacking whole columns.
+#   classification: a class value, or a list (or set) of them, to keep
+#   return_number: keep only this return number (e.g., 1 for first returns)
+#   bbox: (xmin,ymin,xmax,ymax) in real coordinates, inclusive
+def las_filter(header,points,classification=None,return_number=None,bbox=None):
+    mask = np.ones(len(points),dtype=bool)
+    if classification is not None:
+        # In formats 0-5, the top three bits of the class byte are flags
+        class_values = points['class']
+        if header['point_data_format_id'] < 6:
+            class_values = class_values & 31
+        if isinstance(classification,(set,frozenset)):
+            classification = list(classification)
+        mask &= np.isin(class_values,np.atleast_1d(classification))
+    if return_number is not None:
+        if header['point_data_format_id'] < 6:
+            mask &= (points['return_byte'] & 7) == return_number
+        else:
+            mask &= (points['return_byte'] & 15) == return_number
+    if bbox is not None:
+        # Convert the box to stored integer units.  The small tolerance keeps
+        # points that sit exactly on an edge from being lost to rounding.
+        for i,name in enumerate(['x','y']):
+            lo = np.ceil((bbox[i] - header['offset'][i]) / header['scale'][i] - 1e-6)
+            hi = np.floor((bbox[i+2] - header['offset'][i]) / header['scale'][i] + 1e-6)
+            values = points[name]
+            mask &= (values >= lo) & (values <= hi)
+    return mask
+
+
+# Names of the columns las_dataframe produces for a header, in order.
+def las_columns(header):
+    if header['point_data_format_id'] < 6:
+        bit_fields = las_legacy_bit_fields
+    else:
+        bit_fields = las_extended_bit_fields
+    names = [name for name,_ in las_point_formats[header['point_data_format_id']]]
+    names = [name for name in names if name not in ['return_byte','mixed_byte']]
+    return names + list(bit_fields.keys())
+
+
+# Builds a pandas dataframe from raw point records, decoding only the
+# requested columns (all columns, as in read_las, by default).
+def las_dataframe(header,points,columns=None):
+    if columns is None:
+        columns = las_columns(header)
+    return pd.DataFrame({name:las_column(header,points,name) for name in columns})
+
+
+# The inverse of las_dataframe: packs a dataframe (or dictionary of columns)
+# into raw point records for the format given in the header.  Coordinates
+# are rounded to the header's scale and offset, and bit fields are packed 
+# back into return_byte and mixed_byte.  Missing columns are written as 
+# zero.  A structured array that already holds raw records (e.g., from 
+# read_las with memory_map=True) is simply cast to the format.
+def las_records(header,data):
+    dt = las_point_dtype(header['point_data_format_id'],header.get('point_data_record_length'))
+    if isinstance(data,np.ndarray) and data.dtype.names is not None and 'return_byte' in data.dtype.names:
+        points = np.zeros(len(data),dtype=dt)
+        for name in dt.names:
+            if name in data.dtype.names:
+                points[name] = data[name]
+        return points
+
+    # Structured arrays are tested by field name, not by value
+    if isinstance(data,np.ndarray) and data.dtype.names is not None:
+        names = list(data.dtype.names)
+        n = len(data)
+    else:
+        names = list(data.keys())
+        n = len(data[names[0]]) if len(names) else 0
+    points = np.zeros(n,dtype=dt)
+    if header['point_data_format_id'] < 6:
+        bit_fields = las_legacy_bit_fields
+    else:
+        bit_fields = las_extended_bit_fields
+    for i,name in enumerate(['x','y','z']):
+        if name in names:
+            points[name] = np.round((np.asarray(data[name]) - header['offset'][i]) / header['scale'][i])
+    for name,(byte_name,first_bit,num_bits) in bit_fields.items():
+        if name in names:
+            value = np.asarray(data[name]).astype(np.uint8) & ((1 << num_bits) - 1)
+            points[byte_name] |= value << first_bit
+    for name in dt.names:
+        if name not in ['x','y','z','return_byte','mixed_byte'] and name in names:
+            points[name] = data[name]
+    return points
+
+
+# Packs a header dictionary (as returned by read_las) into the bytes of a
+# public header block.
+def pack_las_header(header):
+    project_id = list(header.get('project_id',[0,0,0])) + [0,0,0]
+    
+    # The legacy (32 bit) counts must be zero for formats 6-10, or when 
+    # there are too many points to count
+    legacy_count = header['num_point_records']
+    legacy_by_return = list(header['num_points_by_return'][:5])
+    if header['point_data_format_id'] >= 6 or legacy_count >= 2**32:
+        legacy_count = 0
+        legacy_by_return = [0,0,0,0,0]
+    data = struct.pack('<4sHHLHH8sBB32s32sHHHLLBHL5L3d3d6d',
+                       b'LASF',
+                       header.get('file_source_id',0),
+                       header.get('global_encoding',0),
+                       project_id[0],project_id[1],project_id[2],b'',
+                       header['version_major'],header['version_minor'],
+                       header.get('system_id','').encode('utf-8')[:32],
+                       header.get('generating_software','').encode('utf-8')[:32],
+                       header['file_creation_day'],
+                       header['file_creation_year'],
+                       header['header_size'],
+                       header['point_data_offset'],
+                       header['num_variable_records'],
+                       header['point_data_format_id'] + 128*header.get('compressed',False),
+                       header['point_data_record_length'],
+                       legacy_count,
+                       *legacy_by_return,
+                       *header['scale'],
+                       *header['offset'],
+                       *header['minmax'])
+    if header['version_minor'] >= 3:
+        data += struct.pack('<Q',header.get('begin_wave_form',0))
+    if header['version_minor'] >= 4:
+        by_return = list(header['num_points_by_return'])
+        by_return = by_return + [0] * (15 - len(by_return))
+        data += struct.pack('<QLQ15Q',0,0,header['num_point_records'],*by_return)
+    return data
+
+
+# Packs a list of variable length records (see read_las_vlrs)
+def pack_las_vlrs(vlrs):
+    data = b''
+    for vlr in vlrs:
+        data += struct.pack('<H16sHH32s',0,vlr['user_id'].encode('utf-8'),
+                            vlr['record_id'],len(vlr['data']),
+                            vlr.get('description','').encode('utf-8')[:32])
+        data += vlr['data']
+    return data
+
+
 #%%
+'''
+Writes point records to a las or laz file in chunks, so that large clouds 
+never need to be held in memory at once.  The header is a dictionary like 
+that returned by read_las; at minimum it needs point_data_format_id, scale 
+and offset.  Point counts and bounds are accumulated as chunks are written
+and filled in when the writer is closed.  Chunks are dataframes in the form
+returned by read_las and iter_las (or raw structured records).
+
+Files ending in .laz are compressed (this requires the lazrs package) 
+unless compress is given explicitly.
+
+Example (writing SMRF results back out, chunk by chunk):
+    chunks = neilpy.iter_las('big.las')
+    header = next(chunks)
+    with neilpy.LasWriter('classified.laz',header) as writer:
+        for df in chunks:
+            df['class'] = ...
+            writer.write(df)
+'''
 
-# Using scipy's binned statistic would be preferable here, but it doesn't do
-# min/max natively, and is too slow when not cython.
-# It would look like: 
-# Z,xi,yi,binnum = stats.binned_statistic_2d(x,y,z,statistic='min',bins=(x_edge,y_edge))
-def create_dem(x,y,z,cellsize=1,bin_type='max',use_binned_statistic=False,inpaint=False):
-    
-    #x = df.x.values
-    #y = df.y.values
-    #z = df.z.values
-    #resolution = 1
-    #bin_type = 'max' 
-    floor2 = lambda x,v: v*np.floor(x/v)
-    ceil2 = lambda x,v: v*np.ceil(x/v)
+class LasWriter:
+
+    def __init__(self,filename,header,compress=None):
+        if compress is None:
+            compress = str(filename).lower().endswith('.laz')
+        if compress and lazrs is None:
+            raise ImportError('Writing LAZ files requires the lazrs package.')
+        
+        fmt = header['point_data_format_id']
+        dt = las_point_dtype(fmt,header.get('point_data_record_length'))
+        today = datetime.date.today()
+        h = dict(header)
+        h['version_major'] = header.get('version_major',1)
+        h['version_minor'] = header.get('version_minor',2)
+        if fmt >= 6:
+            h['version_minor'] = max(h['version_minor'],4)
+        h['header_size'] = {3:235,4:375}.get(h['version_minor'],227)
+        h['generating_software'] = 'neilpy'
+        h['file_creation_day'] = header.get('file_creation_day',today.timetuple().tm_yday)
+        h['file_creation_year'] = header.get('file_creation_year',today.year)
+        h['point_data_record_length'] = dt.itemsize
+        h['compressed'] = compress
+        h['begin_wave_form'] = 0
+        h['num_evlrs'] = 0
+        h['evlrs'] = []
+        h['num_point_records'] = 0
+        h['num_points_by_return'] = [0] * 15
+        
+        # Carry over the VLRs (e.g., the CRS), replacing any laszip VLR.
+        # EVLRs small enough to be stored as VLRs are kept too.
+        vlrs = header.get('vlrs',[]) + [evlr for evlr in header.get('evlrs',[]) if len(evlr['data']) < 2**16]
+        vlrs = [vlr for vlr in vlrs if vlr['user_id'] != 'laszip encoded']
+        if compress:
+            self._laz_vlr = lazrs.LazVlr.new_for_compression(fmt,dt.itemsize - np.dtype(las_point_formats[fmt]).itemsize)
+            vlrs.append({'user_id':'laszip encoded','record_id':22204,
+                         'description':'lazrs','data':self._laz_vlr.record_data()})
+        h['vlrs'] = vlrs
+        h['num_variable_records'] = len(vlrs)
+        h['point_data_offset'] = h['header_size'] + sum(54 + len(vlr['data']) for vlr in vlrs)
+        self.header = h
+        self.dtype = dt
+        self._min = np.full(3,np.iinfo(np.int32).max,dtype=np.int64)
+        self._max = np.full(3,np.iinfo(np.int32).min,dtype=np.int64)
+        
+        self.file = open(filename,mode='wb')
+        self._write_header()
+        self.compressor = None
+        if compress:
+            self.compressor = lazrs.ParLasZipCompressor(self.file,self._laz_vlr)
+
+    def _write_header(self):
+        h = self.header
+        if h['num_point_records'] > 0:
+            mn = self._min * h['scale'] + np.array(h['offset'])
+            mx = self._max * h['scale'] + np.array(h['offset'])
+            h['minmax'] = (mx[0],mn[0],mx[1],mn[1],mx[2],mn[2])
+        else:
+            h['minmax'] = (0,0,0,0,0,0)
+        self.file.seek(0)
+        self.file.write(pack_las_header(h))
+        self.file.write(pack_las_vlrs(h['vlrs']))
+    
+    def write(self,data):
+        points = las_records(self.header,data)
+        if len(points)==0:
+            return
+        for i,name in enumerate(['x','y','z']):
+            self._min[i] = min(self._min[i],points[name].min())
+            self._max[i] = max(self._max[i],points[name].max())
+        if self.header['point_data_format_id'] < 6:
+            return_number = points['return_byte'] & 7
+        else:
+            return_number = points['return_byte'] & 15
+        by_return = np.bincount(return_number,minlength=16)[1:16]
+        self.header['num_points_by_return'] = [a+b for a,b in zip(self.header['num_points_by_return'],by_return.tolist())]
+        self.header['num_point_records'] += len(points)
+        if self.compressor is None:
+            points.tofile(self.file)
+        else:
+            self.compressor.compress_many(points.view(np.uint8))
     
+    def close(self):
+        if self.file.closed:
+            return
+        if self.compressor is not None:
+            self.compressor.done()
+        self._write_header()
+        self.file.close()
     
-    xedges = np.arange(floor2(np.min(x),cellsize)-.5*cellsize,
-                       ceil2(np.max(x),cellsize) + 1.5*cellsize,cellsize)
-    yedges = np.arange(ceil2(np.max(y),cellsize)+.5*cellsize,
-                       floor2(np.min(y),cellsize) - 1.5*cellsize,-cellsize)
-    nx, ny = len(xedges)-1,len(yedges)-1
+    def __enter__(self):
+        return self
     
-    I = np.empty(nx*ny)
-    I[:] = np.nan
+    def __exit__(self,*args):
+        self.close()
+
+
+# Writes a complete las (or laz) file from a header and the points (as 
+# returned by read_las).  See LasWriter for writing in chunks.
+def write_las(filename,header,data,compress=None):
+    with LasWriter(filename,header,compress) as writer:
+        writer.write(data)
+
+#%%
+'''
+An index of a collection of las/laz tiles, built by reading only the header
+of each file.  The catalog can report which tiles intersect a bounding box, 
+and read points from those tiles concurrently into one dataframe.  
+
+The files can be given as a directory, a glob pattern, or a list.  The 
+index is a dataframe with one row per tile, holding its bounds, point count,
+format and EPSG code (see read_las_header).  Headers are scanned on n_jobs threads.
+
+Example:
+    catalog = neilpy.LasCatalog('project/tiles')
+    bbox = (512000,5403000,513000,5404000)   # xmin,ymin,xmax,ymax
+    print(catalog.intersects(bbox))
+    df = catalog.read(bbox,columns=['x','y','z','class'],n_jobs=8)
+
+Reading with use_processes=True spawns fresh worker processes, so (as with
+any multiprocessing code) scripts should guard their entry point with 
+if __name__ == '__main__'.
+'''
+
+class LasCatalog:
+    
+    def __init__(self,files,n_jobs=None):
+        if isinstance(files,str):
+            if os.path.isdir(files):
+                files = glob.glob(os.path.join(files,'*.las')) + glob.glob(os.path.join(files,'*.laz'))
+            else:
+                files = glob.glob(files)
+        files = sorted(files)
+        with concurrent.futures.ThreadPoolExecutor(n_jobs) as executor:
+            headers = list(executor.map(read_las_header,files))
+        index = []
+        for filename,header in zip(files,headers):
+            xmax,xmin,ymax,ymin,zmax,zmin = header['minmax']
+            index.append({'filename':filename,'xmin':xmin,'ymin':ymin,'xmax':xmax,
+                          'ymax':ymax,'zmin':zmin,'zmax':zmax,
+                          'num_points':header['num_point_records'],
+                          'point_data_format_id':header['point_data_format_id'],
+                          'compressed':header['compressed'],'epsg':header['epsg']})
+        self.index = pd.DataFrame(index,columns=['filename','xmin','ymin','xmax','ymax',
+                                                 'zmin','zmax','num_points',
+                                                 'point_data_format_id','compressed','epsg'])
+    
+    def __len__(self):
+        return len(self.index)
+    
+    # The bounds (xmin,ymin,xmax,ymax) of all tiles together
+    @property
+    def bounds(self):
+        return (self.index.xmin.min(),self.index.ymin.min(),
+                self.index.xmax.max(),self.index.ymax.max())
+        
+    # Returns the filenames of the tiles whose bounds overlap bbox
+    def intersects(self,bbox):
+        xmin,ymin,xmax,ymax = bbox
+        idx = (self.index.xmin <= xmax) & (self.index.xmax >= xmin) & \
+              (self.index.ymin <= ymax) & (self.index.ymax >= ymin)
+        return self.index.filename[idx].tolist()
+    
+    # Reads the points of all tiles intersecting bbox (or all tiles), on 
+    # n_jobs threads, or processes if use_processes is True.  columns and 
+    # the filters are passed on to read_las, so only the points inside bbox
+    # are decoded.  Returns a single dataframe.
+    def read(self,bbox=None,columns=None,classification=None,return_number=None,
+             n_jobs=None,use_processes=False):
+        if bbox is None:
+            files = self.index.filename.tolist()
+        else:
+            files = self.intersects(bbox)
+        args = [(filename,columns,classification,return_number,bbox) for filename in files]
+        with _executor(n_jobs,use_processes) as executor:
+            frames = list(executor.map(_read_las_data,args))
+        if len(frames)==0:
+            return pd.DataFrame(columns=columns)
+        return pd.concat(frames,ignore_index=True)
+
+
+# Returns a thread or process pool with n_jobs workers.  Worker processes 
+# are spawned rather than forked, since forking a process that has already
+# started threads (e.g., lazrs's decompression pool) can deadlock.
+def _executor(n_jobs=None,use_processes=False):
+    if use_processes:
+        return concurrent.futures.ProcessPoolExecutor(n_jobs,mp_context=multiprocessing.get_context('spawn'))
+    return concurrent.futures.ThreadPoolExecutor(n_jobs)
+
+
+# A picklable helper for LasCatalog.read, returning only the points
+def _read_las_data(args):
+    filename,columns,classification,return_number,bbox = args
+    return read_las(filename,columns=columns,classification=classification,
+                    return_number=return_number,bbox=bbox)[1]
+
+
+#%% Gridding
+
+# The transform and shape (rows, cols) of a grid of cellsize covering the 
+# points with extent xmin,ymin,xmax,ymax, with cell centers at multiples of 
+# cellsize and one spare cell on every side, as create_dem has always used.
+def _grid_definition(xmin,ymin,xmax,ymax,cellsize=1):
+    floor2 = lambda x,v: v*np.floor(x/v)
+    ceil2 = lambda x,v: v*np.ceil(x/v)
     
-    # Define an affine matrix, and convert realspace coordinates to integer pixel
-    # coordinates
+    xedges = np.arange(floor2(xmin,cellsize)-.5*cellsize,
+                       ceil2(xmax,cellsize) + 1.5*cellsize,cellsize)
+    yedges = np.arange(ceil2(ymax,cellsize)+.5*cellsize,
+                       floor2(ymin,cellsize) - 1.5*cellsize,-cellsize)
     t = rasterio.transform.from_origin(xedges[0], yedges[0], cellsize, cellsize)
-    c,r = ~t * (x,y)
+    return t,(len(yedges)-1,len(xedges)-1)
+
+
+# The flat cell index of each point in a grid of transform t and shape, and 
+# a mask of which points fall within the grid
+def _grid_index(x,y,t,shape):
+    c,r = ~t * (np.asarray(x),np.asarray(y))
     c,r = np.floor(c).astype(np.int64), np.floor(r).astype(np.int64)
+    inside = (r>=0) & (r<shape[0]) & (c>=0) & (c<shape[1])
+    if not np.all(inside):
+        r,c = r[inside],c[inside]
+    return np.ravel_multi_index((r,c),shape),inside
+
+
+'''
+Grids points into rasters of several per-cell statistics in one pass, using
+numpy scatter reductions (bincount, np.minimum.at, np.maximum.at) rather than
+sorting or grouping, so that apart from the cell index of each point the 
+memory used is proportional to the grid.  statistics is a list of:
+    'min', 'max', 'mean', 'count', 'sum', 'std' (population), 'range',
+    'median', or 'pNN' for the NNth percentile (e.g. 'p95'), interpolated 
+    linearly as np.percentile does.  The median and percentiles need the 
+    points ordered within each cell, and so are the only statistics that sort.
+Any of these may be prefixed with 'first_' or 'last_' (e.g. 'last_max' for a
+last-return DSM) to use only first or last returns, which needs 
+return_number and number_of_returns.
+
+By default the grid covers the points as in create_dem; pass transform and 
+shape (rows, cols) to grid onto a fixed grid instead, in which case points
+outside it are ignored.  Empty cells are NaN (0 for counts).
+
+Returns a dict of rasters, keyed by statistic, and the affine transform.
+
+Example:
+    grids,t = neilpy.grid_statistics(df.x,df.y,df.z,['min','max','mean','count','p95'],cellsize=1)
+'''
+
+def grid_statistics(x,y,z,statistics=['max'],cellsize=1,transform=None,shape=None,
+                    return_number=None,number_of_returns=None):
+    x,y,z = np.asarray(x),np.asarray(y),np.asarray(z,dtype=np.float64)
+    if isinstance(statistics,str):
+        statistics = [statistics]
+    if transform is None:
+        transform,shape = _grid_definition(np.min(x),np.min(y),np.max(x),np.max(y),cellsize)
+    i,inside = _grid_index(x,y,transform,shape)
+    z = z[inside]
+    
+    # Group the requested statistics by the returns they use
+    subsets = {}
+    for statistic in statistics:
+        subset,name = '',statistic
+        if statistic.startswith('first_') or statistic.startswith('last_'):
+            subset,name = statistic.split('_',1)
+        subsets.setdefault(subset,[]).append((statistic,name))
+    
+    grids = {}
+    for subset,names in subsets.items():
+        if subset=='':
+            i_s,z_s = i,z
+        else:
+            if return_number is None or number_of_returns is None:
+                raise ValueError(subset + '_ statistics need return_number and number_of_returns.')
+            rn = np.asarray(return_number)[inside]
+            if subset=='first':
+                use = rn==1
+            else:
+                use = rn==np.asarray(number_of_returns)[inside]
+            i_s,z_s = i[use],z[use]
+        cell_stats = _cell_statistics(i_s,z_s,[name for statistic,name in names],shape[0]*shape[1])
+        for statistic,name in names:
+            grids[statistic] = cell_stats[name].reshape(shape)
+    return grids,transform
+
+
+# Computes each of statistics for the values z with flat cell indices i, for
+# a grid of n cells
+def _cell_statistics(i,z,statistics,n):
+    count = np.bincount(i,minlength=n)
+    empty = count==0
+    out,cache = {},{}
+    
+    def reduce(name):
+        if name not in cache:
+            if name=='sum':
+                cache[name] = np.bincount(i,weights=z,minlength=n)
+            elif name=='min':
+                cache[name] = np.full(n,np.inf)
+                np.minimum.at(cache[name],i,z)
+            elif name=='max':
+                cache[name] = np.full(n,-np.inf)
+                np.maximum.at(cache[name],i,z)
+            elif name=='mean':
+                with np.errstate(invalid='ignore',divide='ignore'):
+                    cache[name] = reduce('sum') / count
+        return cache[name]
+    
+    for statistic in statistics:
+        if statistic=='count':
+            out[statistic] = count.astype(np.float64)
+            continue
+        if statistic in ['min','max','sum','mean']:
+            grid = reduce(statistic).copy()
+        elif statistic=='range':
+            grid = reduce('max') - reduce('min')
+        elif statistic=='std':
+            grid = np.sqrt(np.bincount(i,weights=(z - reduce('mean')[i])**2,minlength=n) / np.maximum(count,1))
+        elif statistic=='median' or (statistic[0]=='p' and statistic[1:].replace('.','',1).isdigit()):
+            q = 50 if statistic=='median' else float(statistic[1:])
+            if q < 0 or q > 100:
+                raise ValueError('Percentiles must be between 0 and 100.')
+            if 'order' not in cache:
+                cache['order'] = np.lexsort((z,i))
+                cache['start'] = np.concatenate(([0],np.cumsum(count)[:-1]))
+            z_sorted = z[cache['order']]
+            grid = np.full(n,np.nan)
+            k = (count[~empty]-1) * q / 100
+            lo = np.floor(k).astype(np.int64)
+            hi = np.minimum(lo+1,count[~empty]-1)
+            start = cache['start'][~empty]
+            grid[~empty] = z_sorted[start+lo] + (k-lo) * (z_sorted[start+hi] - z_sorted[start+lo])
+        else:
+            raise ValueError('Statistic ' + str(statistic) + ' not supported.')
+        grid[empty] = np.nan
+        out[statistic] = grid
+    return out
+
+
+#%%
+
+'''
+Creates a DEM from points, taking the bin_type statistic (any of those 
+supported by grid_statistics, e.g. 'max' for a DSM, 'min' for a ground 
+surface) in each cell.  Returns the DEM and its affine transform.
+
+With n_jobs other than 1 (None for one per CPU), the points are gridded in 
+parallel worker processes, which index, partition and reduce the points in 
+shared memory (see _parallel_grid); the result is identical to the serial 
+one.  The pool of workers is started on first use and kept for later calls,
+or pool may be given (any concurrent.futures executor, e.g. one shared with
+other work), in which case n_jobs is ignored.  As with any multiprocessing 
+code, scripts should guard their entry point with if __name__ == '__main__'.
+
+To grid point clouds too large for memory, accumulate them with 
+DemAccumulator.
+
+Empty cells are NaN unless inpaint is given, as:
+    True or 'springs': inpaint_nans_by_springs, a global least-squares fill
+    'idw': inpaint_idw, inverse distance weighting of the nearest cells
+    'tin': inpaint_tin, linear interpolation on a Delaunay triangulation
+    'nearest': the value of the nearest cell
+Other keyword arguments (e.g. k, power, max_distance for 'idw') are passed on
+to the inpainting function.
+'''
+
+def create_dem(x,y,z,cellsize=1,bin_type='max',use_binned_statistic=False,inpaint=False,
+               n_jobs=1,pool=None,**inpaint_kwargs):
     
-    # Old way:
-    # Use pixel coordiantes to create a flat index; use that index to aggegrate, 
-    # using pandas.
+    # scipy's binned statistic is kept for comparison; its bins are x by y.  
+    # Bins are closed on their low side, so y is negated to put points on 
+    # an edge in the row below it, as grid_statistics does, and the result 
+    # is transposed to rows and columns.
     if use_binned_statistic:
-        I = stats.binned_statistic_2d(x,y,z,statistic='min',bins=(xedges,yedges))
+        t,(ny,nx) = _grid_definition(np.min(x),np.min(y),np.max(x),np.max(y),cellsize)
+        xedges = t.c + cellsize*np.arange(nx+1)
+        yedges = -t.f + cellsize*np.arange(ny+1)
+        I = stats.binned_statistic_2d(x,-np.asarray(y),z,statistic=bin_type,bins=(xedges,yedges))[0]
+        I = I.T
+    elif n_jobs != 1 or pool is not None:
+        I,t = _parallel_grid(x,y,z,bin_type,cellsize,n_jobs,pool)
     else:        
-        mx = pd.DataFrame({'i':np.ravel_multi_index((r,c),(ny,nx)),'z':z}).groupby('i')
-        del c,r
-        if bin_type=='max':
-            mx = mx.max()
-        elif bin_type=='min':
-            mx = mx.min()
-        else:
-            raise ValueError('This type not supported.')
+        grids,t = grid_statistics(x,y,z,[bin_type],cellsize=cellsize)
+        I = grids[bin_type]
         
-        I.flat[mx.index.values] = mx.values
-        I = I.reshape((ny,nx))
-        
-    if inpaint==True:
-        I = inpaint_nans_by_springs(I)
+    I = _inpaint_dem(I,inpaint,**inpaint_kwargs)
     
     return I,t
 
 
+# Fills the empty cells of a DEM with one of the inpainting methods
+def _inpaint_dem(I,inpaint=False,**kwargs):
+    if inpaint is False or inpaint is None:
+        return I
+    if inpaint is True or inpaint=='springs':
+        return inpaint_nans_by_springs(I,**kwargs)
+    elif inpaint=='idw':
+        return inpaint_idw(I,inplace=True,**kwargs)
+    elif inpaint=='tin':
+        return inpaint_tin(I,inplace=True,**kwargs)
+    elif inpaint=='nearest':
+        return inpaint_nearest(I,**kwargs)
+    else:
+        raise ValueError('Inpainting method ' + str(inpaint) + ' not supported.')
+
+
+# Grids points in parallel for create_dem.  The points are copied into shared
+# memory once, and the workers then do all of the work on them, each over a
+# contiguous range of points, in three passes:
+#   1. The bounds of each range, from which the grid is defined.
+#   2. The cell index of each point, with each range then ordered (in place, 
+#      by a radix sort) by the band of rows its points fall in.
+#   3. For each band, its segment of every range is gathered and reduced into
+#      the band's rows of a shared output grid.
+# Within a band the points keep their original order, and bands share no 
+# cells, so the result is identical to the serial one.  Workers neither 
+# receive the points nor return grids by pickling.
+def _parallel_grid(x,y,z,statistic,cellsize=1,n_jobs=None,pool=None):
+    if pool is None:
+        pool = _process_pool(n_jobs)
+    n_workers = getattr(pool,'_max_workers',None) or os.cpu_count() or 1
+    n = len(x)
+    
+    blocks = []
+    try:
+        for values in (x,y,z):
+            _shared_array(blocks,n,np.float64)[:] = values
+        names = [block.name for block in blocks]
+        
+        # Several ranges and bands per worker keep the workers evenly loaded. 
+        # The bands are few enough for numpy's radix sort.
+        edges = np.unique(np.linspace(0,n,4*n_workers+1).astype(np.int64))
+        ranges = list(zip(edges[:-1],edges[1:]))
+        bounds = np.array(list(pool.map(_point_bounds,[(names,n,a,b) for a,b in ranges])))
+        t,shape = _grid_definition(np.min(bounds[:,0]),np.min(bounds[:,1]),
+                                   np.max(bounds[:,2]),np.max(bounds[:,3]),cellsize)
+        n_bands = int(min(shape[0],4*n_workers,32767))
+        band_rows = int(np.ceil(shape[0] / n_bands))
+        n_bands = int(np.ceil(shape[0] / band_rows))
+        counts = list(pool.map(_index_points,[(names,n,a,b,t,shape,band_rows*shape[1],n_bands) 
+                                              for a,b in ranges]))
+        starts = [a + np.concatenate(([0],np.cumsum(c))) for (a,b),c in zip(ranges,counts)]
+        
+        I = _shared_array(blocks,shape,np.float64)
+        args = [(names + [blocks[-1].name],n,[(s[k],s[k+1]) for s in starts if s[k+1] > s[k]],
+                 shape,k*band_rows,min((k+1)*band_rows,shape[0]),statistic) 
+                for k in range(n_bands)]
+        list(pool.map(_grid_band,args))
+        I = I.copy()
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+    return I,t
+
+
+# Process pools kept for reuse, by number of workers, as spawning workers 
+# (each of which imports neilpy) costs far more than most calls
+_process_pools = {}
+
+def _process_pool(n_jobs=None):
+    n_jobs = n_jobs or os.cpu_count() or 1
+    if n_jobs not in _process_pools:
+        _process_pools[n_jobs] = _executor(n_jobs,use_processes=True)
+    return _process_pools[n_jobs]
+
+
+def _shared_array(blocks,shape,dtype):
+    block = shared_memory.SharedMemory(create=True,size=max(int(np.prod(shape))*np.dtype(dtype).itemsize,1))
+    blocks.append(block)
+    return np.ndarray(shape,dtype=dtype,buffer=block.buf)
+
+
+# Attaches to the shared arrays of _parallel_grid: x (later the ordered cell 
+# indices), y, z, and the output grid if there is one
+def _attach_grid_arrays(names,n,shape=None):
+    blocks = [shared_memory.SharedMemory(name=name) for name in names]
+    arrays = [np.ndarray(n,dtype=np.float64,buffer=block.buf) for block in blocks[:3]]
+    if shape is not None:
+        arrays.append(np.ndarray(shape,dtype=np.float64,buffer=blocks[3].buf))
+    return blocks,arrays
+
+
+def _close_blocks(blocks,arrays):
+    del arrays[:]
+    for block in blocks:
+        block.close()
+
+
+# The (xmin,ymin,xmax,ymax) of points a to b, for _parallel_grid
+def _point_bounds(args):
+    names,n,a,b = args
+    blocks,arrays = _attach_grid_arrays(names,n)
+    try:
+        x,y = arrays[0][a:b],arrays[1][a:b]
+        return np.min(x),np.min(y),np.max(x),np.max(y)
+    finally:
+        x = y = None
+        _close_blocks(blocks,arrays)
+
+
+# Indexes points a to b for _parallel_grid and orders them by band, writing 
+# their cell indices over x (which is no longer needed) and reordering z.
+# Returns the number of points in each band.
+def _index_points(args):
+    names,n,a,b,t,shape,band_cells,n_bands = args
+    blocks,arrays = _attach_grid_arrays(names,n)
+    try:
+        x,y,z = arrays
+        i,_ = _grid_index(x[a:b],y[a:b],t,shape)
+        band = (i // band_cells).astype(np.int16)
+        order = np.argsort(band,kind='stable')
+        np.ndarray(n,dtype=np.int64,buffer=blocks[0].buf)[a:b] = i[order]
+        z[a:b] = z[a:b][order]
+        return np.bincount(band,minlength=n_bands)
+    finally:
+        x = y = z = None
+        _close_blocks(blocks,arrays)
+
+
+# Reduces one band of rows for _parallel_grid, from its segments of each 
+# range of points
+def _grid_band(args):
+    names,n,segments,shape,row0,row1,statistic = args
+    blocks,arrays = _attach_grid_arrays(names,n,shape)
+    try:
+        cells = np.ndarray(n,dtype=np.int64,buffer=blocks[0].buf)
+        z,I = arrays[2],arrays[3]
+        if len(segments):
+            i = np.concatenate([cells[s:e] for s,e in segments]) - row0*shape[1]
+            values = np.concatenate([z[s:e] for s,e in segments])
+        else:
+            i,values = np.zeros(0,dtype=np.int64),np.zeros(0)
+        band = _cell_statistics(i,values,[statistic],(row1-row0)*shape[1])
+        I[row0:row1] = band[statistic].reshape((row1-row0,shape[1]))
+    finally:
+        cells = z = I = None
+        _close_blocks(blocks,arrays)
+
+
+#%%
+
+'''
+Accumulates points into a DEM chunk by chunk, so that point clouds far larger
+than memory (many tiles, or files read with iter_las) can be gridded.  The 
+grid is fixed up front from bounds (xmin,ymin,xmax,ymax), laid out as 
+create_dem would lay it out for points with that extent, or from an explicit
+transform and shape.  Running min, max, sum and count grids are kept; points
+outside the grid are ignored.  Accumulators over the same grid (e.g. from 
+separate workers) can be combined with merge.
+
+Example:
+    catalog = neilpy.LasCatalog('tiles/')
+    acc = neilpy.DemAccumulator(catalog.bounds,cellsize=1)
+    for filename in catalog.index.filename:
+        reader = neilpy.iter_las(filename,columns=['x','y','z'],classification=[2])
+        next(reader)
+        for df in reader:
+            acc.add(df.x,df.y,df.z)
+    Z,t = acc.finalize('min')
+'''
+
+class DemAccumulator:
+    
+    def __init__(self,bounds=None,cellsize=1,transform=None,shape=None):
+        if transform is None:
+            transform,shape = _grid_definition(*bounds,cellsize)
+        self.transform = transform
+        self.shape = tuple(shape)
+        self.min = np.full(self.shape,np.inf)
+        self.max = np.full(self.shape,-np.inf)
+        self.sum = np.zeros(self.shape)
+        self.count = np.zeros(self.shape,dtype=np.int64)
+    
+    # Adds a chunk of points, returning how many fell within the grid
+    def add(self,x,y,z):
+        i,inside = _grid_index(x,y,self.transform,self.shape)
+        z = np.asarray(z,dtype=np.float64)[inside]
+        n = self.min.size
+        np.minimum.at(self.min.reshape(-1),i,z)
+        np.maximum.at(self.max.reshape(-1),i,z)
+        self.sum += np.bincount(i,weights=z,minlength=n).reshape(self.shape)
+        self.count += np.bincount(i,minlength=n).reshape(self.shape)
+        return len(i)
+    
+    def merge(self,other):
+        if other.transform != self.transform or other.shape != self.shape:
+            raise ValueError('Only accumulators over the same grid can be merged.')
+        np.minimum(self.min,other.min,out=self.min)
+        np.maximum(self.max,other.max,out=self.max)
+        self.sum += other.sum
+        self.count += other.count
+        return self
+    
+    # Returns the bin_type ('min','max','mean','sum','count' or 'range') DEM
+    # and its transform, as create_dem does
+    def finalize(self,bin_type='max',inpaint=False):
+        empty = self.count==0
+        with np.errstate(invalid='ignore',divide='ignore'):
+            if bin_type in ['min','max','sum']:
+                I = getattr(self,bin_type).copy()
+            elif bin_type=='mean':
+                I = self.sum / self.count
+            elif bin_type=='count':
+                return self.count.astype(np.float64),self.transform
+            elif bin_type=='range':
+                I = self.max - self.min
+            else:
+                raise ValueError('This type not supported.')
+        I[empty] = np.nan
+        I = _inpaint_dem(I,inpaint)
+        return I,self.transform
+
+
 #%% Inpainting.  See research/current/inpaint/inpaint_nans.py for full details
 # Finite difference approximation
 def inpaint_nans_by_fda(A,fast=True,inplace=False):
@@ -741,7 +1894,7 @@ def inpaint_nans_by_fda(A,fast=True,inplace=False):
                        -2*np.ones(m*(n-2),dtype=np.int64)
                        ))
     if fast==True:
-        goodrows = np.in1d(i,index[ndi.binary_dilation(nanmat)])
+        goodrows = np.isin(i,index[ndi.binary_dilation(nanmat)])
         i = i[goodrows]
         j = j[goodrows]
         data = data[goodrows]
@@ -771,8 +1924,27 @@ def unique_rows(a):
     unique_a = np.unique(a.view([('', a.dtype)]*a.shape[1]))
     return unique_a.view(a.dtype).reshape((unique_a.shape[0], a.shape[1]))
             
+'''
+Fills NaN cells as if each cell were joined to its 4 neighbors by springs,
+solving for the cell values that minimize the total spring energy.  The 
+solver may be:
+    'lsqr': least squares on the spring equations (the original method)
+    'cg': conjugate gradient on the normal equations of the spring system, a
+        sparse, symmetric positive definite Laplacian over the NaN cells, 
+        with a diagonal (Jacobi) preconditioner
+    'amg': the same Laplacian, solved by conjugate gradient preconditioned 
+        with algebraic multigrid (requires pyamg); much the fastest on large
+        connected NaN regions such as water bodies or removed buildings
+    'direct': the same Laplacian, factorized directly (exact, but memory 
+        grows quickly with the number of NaN cells)
+tol is the solver's relative tolerance (lsqr's atol and btol).  With 
+return_info, a dict of the solver, iterations and relative residual of the 
+Laplacian system is also returned.
+'''
+
 # At the moment, only 4 neighbors are supported.
-def inpaint_nans_by_springs(A,inplace=False,neighbors=4):
+def inpaint_nans_by_springs(A,inplace=False,neighbors=4,solver='lsqr',tol=None,
+                            return_info=False):
 
     m,n = np.shape(A)
     nanmat = np.isnan(A)
@@ -780,6 +1952,27 @@ def inpaint_nans_by_springs(A,inplace=False,neighbors=4):
     nan_list = np.flatnonzero(nanmat)
     known_list = np.flatnonzero(~nanmat)
     
+    if solver=='lsqr':
+        results,info = _springs_lsqr(A,nan_list,known_list,neighbors,tol)
+    elif solver in ['cg','amg','direct']:
+        L,rhs = _springs_laplacian(A,nanmat,nan_list)
+        results,info = _solve_laplacian(L,rhs,solver,tol)
+    else:
+        raise ValueError('Solver ' + str(solver) + ' not supported.')
+    
+    if inplace:
+        A[np.unravel_index(nan_list,(m,n))] = results
+        B = None
+    else:
+        B = A.copy()
+        B[np.unravel_index(nan_list,(m,n))] = results
+    if return_info:
+        return B,info
+    return B
+
+
+def _springs_lsqr(A,nan_list,known_list,neighbors=4,tol=None):
+    m,n = np.shape(A)
     r,c = np.unravel_index(nan_list,(m,n))
     
     num_neighbors = neighbors
@@ -809,27 +2002,354 @@ def inpaint_nans_by_springs(A,inplace=False,neighbors=4):
     del i,data
     
     rhs = -springs[:,known_list] * A[np.unravel_index(known_list,(m,n))]
-    results = sparse.linalg.lsqr(springs[:,nan_list],rhs)[0]       
+    if tol is None:
+        output = sparse.linalg.lsqr(springs[:,nan_list],rhs)
+    else:
+        output = sparse.linalg.lsqr(springs[:,nan_list],rhs,atol=tol,btol=tol)
+    # lsqr's arnorm is the residual of the normal equations, i.e. the Laplacian
+    rhs = springs[:,nan_list].T @ rhs
+    return output[0],{'solver':'lsqr','iterations':output[2],'residual':output[7] / max(np.linalg.norm(rhs),1e-300)}
 
-    if inplace:
-        A[np.unravel_index(nan_list,(m,n))] = results
+
+# The normal equations of the spring system: a graph Laplacian over the NaN
+# cells, where each NaN cell's diagonal is its number of neighbors, each pair
+# of neighboring NaN cells is joined by -1, and known neighbors' values move
+# to the right hand side.
+def _springs_laplacian(A,nanmat,nan_list):
+    m,n = np.shape(A)
+    unknown = -np.ones((m,n),dtype=np.int64)
+    unknown.flat[nan_list] = np.arange(len(nan_list))
+    degree = np.zeros(len(nan_list))
+    rhs = np.zeros(len(nan_list))
+    rows,cols = [],[]
+    # Each horizontal and vertical pair of adjacent cells is one spring
+    for a,b in [((slice(None),slice(None,-1)),(slice(None),slice(1,None))),
+                ((slice(None,-1),slice(None)),(slice(1,None),slice(None)))]:
+        ua,ub = unknown[a].ravel(),unknown[b].ravel()
+        for u,v,value in [(ua,ub,A[b].ravel()),(ub,ua,A[a].ravel())]:
+            idx = u>=0
+            np.add.at(degree,u[idx],1)
+            both = idx & (v>=0)
+            rows.append(u[both])
+            cols.append(v[both])
+            known = idx & (v<0)
+            np.add.at(rhs,u[known],value[known])
+    rows,cols = np.concatenate(rows),np.concatenate(cols)
+    L = sparse.coo_matrix((np.concatenate((degree,-np.ones(len(rows)))),
+                           (np.concatenate((np.arange(len(nan_list)),rows)),
+                            np.concatenate((np.arange(len(nan_list)),cols)))),
+                          (len(nan_list),len(nan_list))).tocsr()
+    return L,rhs
+
+
+def _solve_laplacian(L,rhs,solver='cg',tol=None):
+    if tol is None:
+        tol = 1e-8
+    iterations = [0]
+    def count(xk):
+        iterations[0] += 1
+    if solver=='direct':
+        x = sparse.linalg.spsolve(L.tocsc(),rhs)
+    elif solver=='amg':
+        if pyamg is None:
+            raise ImportError('The amg solver requires pyamg.')
+        M = pyamg.smoothed_aggregation_solver(L,symmetry='symmetric').aspreconditioner(cycle='V')
+        x,_ = sparse.linalg.cg(L,rhs,rtol=tol,M=M,callback=count,maxiter=10*L.shape[0])
     else:
-        B = A.copy()
-        B[np.unravel_index(nan_list,(m,n))] = results
-        return B
+        # An incomplete LU factorization is not symmetric, and can stall 
+        # conjugate gradient on large holes, so the diagonal is used
+        M = sparse.diags(1 / L.diagonal())
+        x,_ = sparse.linalg.cg(L,rhs,rtol=tol,M=M,callback=count,maxiter=10*L.shape[0])
+    residual = np.linalg.norm(L @ x - rhs) / max(np.linalg.norm(rhs),1e-300)
+    return x,{'solver':solver,'iterations':iterations[0],'residual':residual}
     
     
     
 #%%
-        
-def inpaint_nearest(X):
-    idx = np.isfinite(X)
-    RI,CI = np.meshgrid(np.arange(X.shape[0]),np.arange(X.shape[1]))
-    f_near = interpolate.NearestNDInterpolator((RI[idx],CI[idx]),X[idx])
-    idx = ~idx
-    X[idx] = f_near(RI[idx],CI[idx])
+
+'''
+Fills NaN cells hole by hole.  Rather than one system spanning the whole 
+raster, each connected region of NaNs is solved on its own with just the 
+cells around it, so cost scales with the area of the holes rather than the 
+size of the raster, and the independent solves run on n_jobs threads.  
+method is 'springs' (inpaint_nans_by_springs) or 'fda' 
+(inpaint_nans_by_fda), and other keyword arguments (e.g. solver) are passed 
+on to it.  The result is the same as filling the whole raster at once: for 
+springs, holes are separated by their one-cell boundary ring, and for fda, 
+whose equations reach two cells from a hole, holes within reach of each 
+other are solved together.  Holes spanning less than tile_size cells are 
+batched, solving those starting in each tile_size x tile_size tile together.
+'''
+
+def inpaint_nans_by_holes(A,method='springs',n_jobs=None,inplace=False,tile_size=256,**kwargs):
+    nanmat = np.isnan(A)
+    if method=='springs':
+        labels,n = ndi.label(nanmat)
+        pad = 1
+    elif method=='fda':
+        groups,n = ndi.label(ndi.binary_dilation(nanmat,structure=np.ones((3,3),dtype=bool)),
+                             structure=np.ones((3,3),dtype=bool))
+        labels = np.where(nanmat,groups,0)
+        pad = 2
+    else:
+        raise ValueError('Method ' + str(method) + ' not supported.')
+    
+    # Holes smaller than tile_size are solved together with the others whose
+    # windows start in the same tile, to save the overhead of many tiny solves
+    B = A if inplace else A.copy()
+    group = np.zeros(n+1,dtype=np.int64)
+    windows = {}
+    for k,hole in enumerate(ndi.find_objects(labels)):
+        if hole is None:
+            continue
+        window = [(max(sl.start-pad,0),min(sl.stop+pad,dim)) for sl,dim in zip(hole,A.shape)]
+        if max(stop-start for start,stop in window) > tile_size:
+            key = ('hole',k)
+        else:
+            key = (window[0][0]//tile_size,window[1][0]//tile_size)
+        if key in windows:
+            g,old = windows[key]
+            window = [(min(a[0],b[0]),max(a[1],b[1])) for a,b in zip(old,window)]
+        else:
+            g = len(windows) + 1
+        windows[key] = (g,window)
+        group[k+1] = g
+    windows = [(g,tuple(slice(*w) for w in window)) for g,window in windows.values()]
+    
+    def fill(args):
+        g,window = args
+        sub = A[window].copy()
+        these_holes = group[labels[window]]==g
+        # NaNs of other holes are out of reach; any value will do
+        sub[np.isnan(sub) & ~these_holes] = 0
+        if method=='springs':
+            sub = inpaint_nans_by_springs(sub,**kwargs)
+        else:
+            sub = inpaint_nans_by_fda(sub,**kwargs)
+        return window,these_holes,sub[these_holes]
+    
+    with concurrent.futures.ThreadPoolExecutor(n_jobs) as executor:
+        for window,these_holes,values in executor.map(fill,windows):
+            B[window][these_holes] = values
+    if not inplace:
+        return B
+
+
+#%%
+
+'''
+Fills the NaN (or nodata) cells of a raster file too large to hold in memory,
+writing the result to out_fn.  Solving blocks independently leaves seams, as
+each block only sees its own edges; here a coarse global solution anchors 
+the blocks, and neighboring blocks are blended across their overlap:
+    1. The raster is averaged down by coarse_factor, block by block, and the
+       coarse grid is filled by inpaint_nans_by_springs.  By default the 
+       factor keeps the coarse grid to about block_size x block_size cells.
+    2. Each block is read with a halo, NaN cells on the outer edge of the halo
+       take their value from the coarse solution (bilinearly interpolated), 
+       and the block is filled by inpaint_nans_by_holes, so only the holes 
+       are solved.
+    3. Each solution is weighted across overlap cells either side of the 
+       block's edges, by cosine ramps that sum to one with the neighboring 
+       blocks' (and whose slopes vanish at their ends), and the weighted
+       solutions are summed.  Cells that were not NaN keep their values.
+       Only the overlap strips still awaiting a neighbor are held, so memory
+       is bounded by the block size and the raster width.
+overlap defaults to half the halo, which keeps the ramps away from the 
+anchored halo edges; it may be at most the halo and half the block size.  
+Other keyword arguments (e.g. solver='amg') are passed on to the springs 
+solver.
+
+Example:
+    Z,t = neilpy.create_dem(x,y,z,cellsize=1,bin_type='min')
+    neilpy.imwrite('dtm_holes.tif',Z,{'transform':t,'crs':'EPSG:26911','nodata':np.nan})
+    neilpy.inpaint_nans_by_blocks('dtm_holes.tif','dtm.tif',halo=128,solver='amg')
+'''
+
+def inpaint_nans_by_blocks(fn,out_fn,block_size=1024,halo=128,coarse_factor=None,
+                           overlap=None,n_jobs=None,compress='deflate',**kwargs):
+    if overlap is None:
+        overlap = halo // 2
+    if overlap > halo or 2*overlap > block_size:
+        raise ValueError('overlap may be at most the halo and half the block size.')
+    with rasterio.open(fn) as src:
+        height,width = src.height,src.width
+        profile = src.profile
+    if coarse_factor is None:
+        coarse_factor = max(1,int(np.ceil(np.sqrt(height*width) / block_size)))
+    f = coarse_factor
+    
+    # Average the raster down by f, block by block
+    coarse_shape = (int(np.ceil(height / f)),int(np.ceil(width / f)))
+    total = np.zeros(coarse_shape[0]*coarse_shape[1])
+    count = np.zeros(coarse_shape[0]*coarse_shape[1])
+    for X,metadata,window,interior in raster_blocks(fn,block_size,0,1,True,True):
+        rows = (window.row_off + np.arange(int(window.height))) // f
+        cols = (window.col_off + np.arange(int(window.width))) // f
+        i = np.ravel_multi_index(np.meshgrid(rows,cols,indexing='ij'),coarse_shape).ravel()
+        valid = np.isfinite(X.ravel())
+        total += np.bincount(i[valid],weights=X.ravel()[valid],minlength=total.size)
+        count += np.bincount(i[valid],minlength=count.size)
+    with np.errstate(invalid='ignore'):
+        coarse = (total / count).reshape(coarse_shape)
+    del total,count
+    coarse = inpaint_nans_by_springs(coarse,**kwargs)
+    
+    # Blocks arrive row by row.  Weighted sums not yet complete are carried: 
+    # those below the current row of blocks in row_carry, and those right of
+    # the current block in col_carry.  Each block writes what is complete.
+    profile = _geotiff_profile(profile,np.result_type(profile['dtype'],np.float32),1,compress)
+    row_carry,next_row_carry = None,None
+    with rasterio.open(out_fn,'w',**profile) as dst:
+        for X,metadata,window,interior in raster_blocks(fn,block_size,halo,1,True,True):
+            r0 = window.row_off - interior[0].start
+            c0 = window.col_off - interior[1].start
+            r_lo,r_end,r_hi,wr = _blend_weights(window.row_off,int(window.height),height,overlap)
+            c_lo,c_end,c_hi,wc = _blend_weights(window.col_off,int(window.width),width,overlap)
+            if window.col_off==0:
+                row_carry,next_row_carry = next_row_carry,np.zeros((r_hi-r_end,width))
+            region = (slice(r_lo-r0,r_hi-r0),slice(c_lo-c0,c_hi-c0))
+            nanmat = np.isnan(X)
+            original = X[region].copy()
+            if np.any(nanmat[region]):
+                # Anchor NaNs on the edges of the halo that lie inside the raster
+                edge = np.zeros(X.shape,dtype=bool)
+                edge[0,:],edge[-1,:] = r0>0,r0+X.shape[0]<height
+                edge[:,0] |= c0>0
+                edge[:,-1] |= c0+X.shape[1]<width
+                r,c = np.nonzero(edge & nanmat)
+                X[r,c] = ndi.map_coordinates(coarse,((r0+r+.5)/f-.5,(c0+c+.5)/f-.5),
+                                             order=1,mode='nearest')
+                X = inpaint_nans_by_holes(X,n_jobs=n_jobs,**kwargs)
+            
+            blended = np.outer(wr,wc) * X[region]
+            if window.col_off > 0:
+                blended[:,:col_carry.shape[1]] += col_carry
+            if window.row_off > 0:
+                blended[:row_carry.shape[0],:c_end-c_lo] += row_carry[:,c_lo:c_end]
+            col_carry = blended[:,c_end-c_lo:]
+            next_row_carry[:,c_lo:c_end] = blended[r_end-r_lo:,:c_end-c_lo]
+            
+            done = blended[:r_end-r_lo,:c_end-c_lo]
+            known = np.isfinite(original[:r_end-r_lo,:c_end-c_lo])
+            done[known] = original[:r_end-r_lo,:c_end-c_lo][known]
+            dst.write(done.astype(profile['dtype']),1,
+                      window=rasterio.windows.Window(c_lo,r_lo,c_end-c_lo,r_end-r_lo))
+
+
+# Blending weights along one axis for a block of size cells starting at 
+# start, of n, with cosine ramps across overlap cells either side of its 
+# inner edges.  Returns the start of the weighted span, the end of the part 
+# complete once this block is added, the end of the span, and the weights.
+def _blend_weights(start,size,n,overlap):
+    lo,hi = max(start-overlap,0),min(start+size+overlap,n)
+    w = np.ones(hi-lo)
+    end = n
+    if overlap > 0:
+        ramp = lambda u: .5 - .5*np.cos(np.pi*np.clip(u,0,1))
+        g = np.arange(lo,hi) + .5
+        if start > 0:
+            w *= ramp((g - (start-overlap)) / (2*overlap))
+        if start+size < n:
+            w *= ramp(((start+size+overlap) - g) / (2*overlap))
+    if start+size < n:
+        end = start+size-overlap
+    return lo,end,hi,w
+
+
+#%%
+
+'''
+Fills NaN cells with the value of the nearest valid cell, using the indices
+returned by a Euclidean distance transform, which takes time linear in the 
+number of cells and works for arrays of any shape or dimension.  By default 
+X is filled in place (and returned); with inplace=False a filled copy is 
+returned.  With return_distance, the distance (in cells) from each cell to 
+the cell that filled it is also returned.
+'''
+
+def inpaint_nearest(X,return_distance=False,inplace=True):
+    if not inplace:
+        X = X.copy()
+    invalid = ~np.isfinite(X)
+    if np.any(invalid) and not np.all(invalid):
+        output = ndi.distance_transform_edt(invalid,return_distances=return_distance,
+                                            return_indices=True)
+        idx = output[1] if return_distance else output
+        X[invalid] = X[tuple(i[invalid] for i in idx)]
+        if return_distance:
+            return X,output[0]
+    if return_distance:
+        return X,np.where(invalid,np.inf,0.0)
     return X
 
+#%%
+
+'''
+Fills NaN cells by inverse distance weighting of the k nearest valid cells 
+(found with a KD-tree), weighted by 1/distance**power.  Only the NaN cells 
+are evaluated, max_distance (in cells) caps the search, leaving cells with 
+no valid cell within reach as NaN, and the queries run in chunks of 
+chunk_size cells to bound memory.  k=1 gives nearest neighbor filling.
+'''
+
+def inpaint_idw(X,k=8,power=2,max_distance=np.inf,chunk_size=1000000,inplace=False):
+    if not inplace:
+        X = X.copy()
+    valid = np.isfinite(X)
+    if np.all(valid) or not np.any(valid):
+        return X
+    tree = spatial.cKDTree(np.argwhere(valid))
+    values = X[valid]
+    holes = np.argwhere(~valid)
+    k = int(min(k,len(values)))
+    for start in range(0,len(holes),chunk_size):
+        query = holes[start:start+chunk_size]
+        d,i = tree.query(query,k=k,distance_upper_bound=np.nextafter(max_distance,np.inf),
+                         workers=-1)
+        d,i = d.reshape((len(query),k)),i.reshape((len(query),k))
+        found = np.isfinite(d)
+        w = np.zeros(d.shape)
+        w[found] = 1 / d[found]**power
+        z = np.zeros(d.shape)
+        z[found] = values[i[found]]
+        with np.errstate(invalid='ignore'):
+            X[query[:,0],query[:,1]] = np.sum(w*z,axis=1) / np.sum(w,axis=1)
+    return X
+
+
+'''
+Fills NaN cells by linear interpolation on a Delaunay triangulation (TIN) of
+the valid cells.  To keep the triangulation small, only the valid cells 
+bordering holes are triangulated, and only the NaN cells are evaluated, in 
+chunks of chunk_size.  Cells outside the triangulation 
+(beyond the convex hull of the data) take the nearest valid value.
+'''
+
+def inpaint_tin(X,chunk_size=1000000,inplace=False):
+    if not inplace:
+        X = X.copy()
+    valid = np.isfinite(X)
+    if np.all(valid) or not np.any(valid):
+        return X
+    edge = valid & ndi.binary_dilation(~valid,structure=np.ones((3,3),dtype=bool))
+    edge_cells = np.argwhere(edge)
+    holes = np.argwhere(~valid)
+    try:
+        f = interpolate.LinearNDInterpolator(edge_cells,X[edge])
+    except spatial.QhullError:
+        f = None
+    for start in range(0,len(holes),chunk_size):
+        query = holes[start:start+chunk_size]
+        if f is None:
+            X[query[:,0],query[:,1]] = np.nan
+        else:
+            X[query[:,0],query[:,1]] = f(query)
+    if np.any(np.isnan(X)):
+        X = inpaint_nearest(X)
+    return X
+
+
 #%%
     
 # ashift pulls a copy of the raster shifted.  0 shifts upper-left to lower right
@@ -862,34 +2382,117 @@ def ashift(surface,direction,n=1,fillnan=False):
 
 #%%
 
-def openness(Z,cellsize=1,lookup_pixels=1,neighbors=np.arange(8),skyview=False):
+'''
+Openness (Yokoyama et al., 2002): the mean, over the neighbors directions 
+(clockwise from upper left, as in ashift), of the smallest zenith angle (in
+radians) to the surface within lookup_pixels cells.  Cells whose view in a 
+direction is all NaN are inf.
+
+The smallest zenith angle is pi/2 less the arctan of the largest rise over 
+distance, and arctan is monotonic, so each direction keeps a running 
+maximum of (shifted elevation - elevation) / distance, updated through 
+views of Z shifted by each distance rather than copies, and takes the 
+arctan once at the end.  Only one direction is held at a time, in dtype 
+(float32 by default; use np.float64 for full precision).  Cells closer to 
+the edge than lookup_pixels also count the edge as level ground, as before.
+'''
 
-    nrows, ncols = np.shape(Z)
-        
-    # neighbor directions are clockwise from top left,starting at zero
-    # neighbors = np.arange(8)   
-    
-    # Define a (fairly large) 3D matrix to hold the minimum angle for each pixel
-    # for each of the requested directions (usually 8)
-    opn = np.Inf * np.ones((len(neighbors),nrows,ncols))
+def openness(Z,cellsize=1,lookup_pixels=1,neighbors=np.arange(8),skyview=False,dtype=np.float32):
+    Z = np.asarray(Z,dtype=dtype)
+    opn = np.zeros(np.shape(Z),dtype=dtype)
+    for direction in np.atleast_1d(neighbors):
+        highest,_ = _openness_sweep(Z,cellsize,lookup_pixels,direction)
+        opn += _zenith_angle(highest)
     
-    # Define an array to calculate distances to neighboring pixels
-    dlist = np.array([np.sqrt(2),1])
+    # Openness is definted as the mean of the minimum angles of all 8 neighbors  
+    return opn / len(np.atleast_1d(neighbors))
 
-    # Calculate minimum angles        
-    for L in np.arange(1,lookup_pixels+1):
-        for i,direction in enumerate(neighbors):
-            # Map distance to this pixel:
-            dist = dlist[direction % 2]
-            dist = cellsize * L * dist
-            # Angle is the arctan of the difference in elevations, divided by distance
-            these_angles = (np.pi/2) - np.arctan((ashift(Z,direction,L)-Z)/dist)
-            this_layer = opn[i,:,:]
-            this_layer[these_angles < this_layer] = these_angles[these_angles < this_layer]
-            opn[i,:,:] = this_layer
 
-    # Openness is definted as the mean of the minimum angles of all 8 neighbors  
-    return np.mean(opn,0)
+'''
+Positive and negative openness from a single sweep: the largest and smallest
+rise over distance come from the same shifted differences, so both are kept
+at once rather than sweeping Z and -Z separately.  Returns the positive and 
+negative openness (means over neighbors, as in openness) and, per direction,
+positive less negative openness in an array of shape 
+(len(neighbors),rows,cols).
+'''
+
+def openness_pair(Z,cellsize=1,lookup_pixels=1,neighbors=np.arange(8),dtype=np.float32):
+    Z = np.asarray(Z,dtype=dtype)
+    neighbors = np.atleast_1d(neighbors)
+    difference = np.empty((len(neighbors),) + np.shape(Z),dtype=dtype)
+    positive = np.zeros(np.shape(Z),dtype=dtype)
+    negative = np.zeros(np.shape(Z),dtype=dtype)
+    for i,direction in enumerate(neighbors):
+        highest,lowest = _openness_sweep(Z,cellsize,lookup_pixels,direction,lowest=True)
+        pos = _zenith_angle(highest)
+        np.negative(lowest,out=lowest)
+        neg = _zenith_angle(lowest)
+        np.subtract(pos,neg,out=difference[i])
+        positive += pos
+        negative += neg
+    return positive / len(neighbors), negative / len(neighbors), difference
+
+
+# The offsets (row, column) of the neighbor seen in each direction, 
+# clockwise from upper left, as in ashift
+_openness_offsets = [(-1,-1),(-1,0),(-1,1),(0,1),(1,1),(1,0),(1,-1),(0,-1)]
+
+
+# Slices of the cells that have a neighbor L cells away along offset, and 
+# of those neighbors
+def _shifted_slices(offset,L,shape):
+    cells,neighbors = [],[]
+    for d,n in zip(offset,shape):
+        k = min(L,n)
+        if d < 0:
+            cells.append(slice(k,n))
+            neighbors.append(slice(0,n-k))
+        elif d > 0:
+            cells.append(slice(0,n-k))
+            neighbors.append(slice(k,n))
+        else:
+            cells.append(slice(0,n))
+            neighbors.append(slice(0,n))
+    return tuple(cells),tuple(neighbors)
+
+
+# Sweeps one direction out to lookup_pixels, returning the largest and/or 
+# smallest (elevation difference / distance) seen from each cell, or -inf 
+# and inf where there is nothing to see
+def _openness_sweep(Z,cellsize,lookup_pixels,direction,highest=True,lowest=False):
+    offset = _openness_offsets[direction]
+    step = cellsize * (np.sqrt(2) if direction % 2 == 0 else 1)
+    high = np.full(np.shape(Z),-np.inf,dtype=Z.dtype) if highest else None
+    low = np.full(np.shape(Z),np.inf,dtype=Z.dtype) if lowest else None
+    tangent = np.empty(np.shape(Z),dtype=Z.dtype)
+    for L in range(1,lookup_pixels+1):
+        cells,neighbors = _shifted_slices(offset,L,np.shape(Z))
+        t = tangent[cells]
+        np.subtract(Z[neighbors],Z[cells],out=t)
+        t /= Z.dtype.type(step * L)
+        if highest:
+            np.fmax(high[cells],t,out=high[cells])
+        if lowest:
+            np.fmin(low[cells],t,out=low[cells])
+    
+    # Near the edge, the cell itself stands in for neighbors beyond it
+    edge = np.ones(np.shape(Z),dtype=bool)
+    edge[_shifted_slices(offset,lookup_pixels,np.shape(Z))[0]] = False
+    level = np.where(np.isfinite(Z[edge]),0,np.nan).astype(Z.dtype)
+    if highest:
+        high[edge] = np.fmax(high[edge],level)
+    if lowest:
+        low[edge] = np.fmin(low[edge],level)
+    return high,low
+
+
+# The zenith angle of the largest tangent, or inf where there is none
+def _zenith_angle(tangent):
+    angle = np.arctan(tangent)
+    np.subtract(tangent.dtype.type(np.pi/2),angle,out=angle)
+    angle[tangent==-np.inf] = np.inf
+    return angle
 
 #%% 
     
@@ -935,16 +2538,16 @@ def skyview_factor(Z,cellsize=1,lookup_pixels=1):
 # to decimal as it progresses.  Upper left pixel is the least significant
 # digit, left pixel is the most significant pixel.
     
-def ternary_pattern_from_openness(Z,cellsize=1,lookup_pixels=1,threshold_angle=0,use_negative_openness=True,lowest=False):
+def ternary_pattern_from_openness(Z,cellsize=1,lookup_pixels=1,threshold_angle=0,use_negative_openness=True,lowest=False,dtype=np.float32):
     pows = 3**np.arange(8)
     #bc = np.zeros(np.shape(Z),dtype=np.uint32)
     tc = np.zeros(np.shape(Z),dtype=np.uint16)
     f = 1
     for i in range(8):
-        O = openness(Z,cellsize,lookup_pixels,neighbors=np.array([i]))
         if use_negative_openness:
-            O = O - openness(-Z,cellsize,lookup_pixels,neighbors=np.array([i]))
+            O = openness_pair(Z,cellsize,lookup_pixels,neighbors=[i],dtype=dtype)[2][0]
         else:
+            O = openness(Z,cellsize,lookup_pixels,neighbors=np.array([i]),dtype=dtype)
             O = O - 90.0
         tempMat = np.ones(np.shape(tc),dtype=np.uint32)
         tempMat[O > threshold_angle] = 2;
@@ -1119,14 +2722,13 @@ def get_geomorphons(Z,cellsize=1,lookup_pixels=5,threshold_angle=1,use_negative_
 
 #%%  Edit to try to include the "correction of forms" section in J&S
     
-def count_openness(Z,cellsize,lookup_pixels,threshold_angle):
+def count_openness(Z,cellsize,lookup_pixels,threshold_angle,dtype=np.float32):
     
     num_pos = np.zeros(np.shape(Z),dtype=np.uint8)
     num_neg = np.zeros(np.shape(Z),dtype=np.uint8)
         
     for i in range(8):        
-        O = openness(Z,cellsize,lookup_pixels,neighbors=np.array([i]))
-        O = O - openness(-Z,cellsize,lookup_pixels,neighbors=np.array([i]))
+        O = openness_pair(Z,cellsize,lookup_pixels,neighbors=[i],dtype=dtype)[2][0]
         num_pos[O > threshold_angle] = num_pos[O > threshold_angle] + 1
         num_neg[O < -threshold_angle] = num_neg[O < -threshold_angle] + 1
     return num_pos, num_neg
@@ -1176,22 +2778,117 @@ def get_geomorphon_from_openness(Z,cellsize=1,lookup_pixels=1,threshold_angle=1,
 
 #%% The Simple Morphological Filter
 
+'''
+Grey-scale morphological opening of Z by a disk of the given radius (as 
+skimage's disk).  For NaN-free input the result is identical to 
+ndi.grey_opening(Z,footprint=disk(radius)).  NaN cells (e.g. the empty cells
+of a create_dem surface that has not been inpainted) are ignored by both the
+erosion and the dilation and are NaN in the result; grey_opening has no 
+defined behavior for NaN, and its output then depends on the scan order.
+A disk is the union of a staircase of centered rectangles, one per distinct
+row width, and erosion by a union is the minimum of the erosions by each 
+part.  Each rectangle is separable into two running minima (or maxima, for
+the dilation), which cost the same per cell whatever their length.  The 
+cost per cell therefore grows with the number of rectangles (about 0.6 
+times the radius) rather than the area of the disk.
+'''
+
+def disk_opening(Z,radius):
+    rectangles = _disk_rectangles(radius)
+    nanmat = np.isnan(Z)
+    if not np.any(nanmat):
+        eroded = _rectangles_filter(Z,rectangles,ndi.minimum_filter1d,np.minimum)
+        return _rectangles_filter(eroded,rectangles,ndi.maximum_filter1d,np.maximum)
+    
+    # Mask NaNs with values that neither filter can select, and restore them
+    eroded = _rectangles_filter(np.where(nanmat,np.inf,Z),rectangles,ndi.minimum_filter1d,np.minimum)
+    eroded[nanmat] = -np.inf
+    opened = _rectangles_filter(eroded,rectangles,ndi.maximum_filter1d,np.maximum)
+    opened[nanmat] = np.nan
+    return opened
+
+
+# The (half height, half width) of the rectangles whose union is disk(radius)
+def _disk_rectangles(radius):
+    radius = int(radius)
+    half_widths = np.floor(np.sqrt(radius**2 - np.arange(radius+1)**2) + 1e-9).astype(int)
+    return [(int(np.max(np.nonzero(half_widths >= w)[0])),int(w)) for w in np.unique(half_widths)]
+
+
+def _rectangles_filter(Z,rectangles,filter1d,combine):
+    out = None
+    columns = {}
+    for h,w in rectangles:
+        if h not in columns:
+            columns[h] = filter1d(Z,2*h+1,axis=0)
+        this = filter1d(columns[h],2*w+1,axis=1)
+        out = this if out is None else combine(out,this,out=out)
+    return out
+
+
 def progressive_filter(Z,windows,cellsize=1,slope_threshold=.15):
     last_surface = Z.copy()
     elevation_thresholds = slope_threshold * (windows * cellsize)  
-    is_object_cell = np.zeros(np.shape(Z),dtype=np.bool)
+    is_object_cell = np.zeros(np.shape(Z),dtype=bool)
     for i,window in enumerate(windows):
         elevation_threshold = elevation_thresholds[i]
-        this_disk = disk(window)
-        if window==1:
-            this_disk = np.ones((3,3),dtype=np.uint8)
-        this_surface = ndi.morphology.grey_opening(last_surface,footprint=disk(window)) 
+        this_surface = disk_opening(last_surface,window)
         is_object_cell = (is_object_cell) | (last_surface - this_surface > elevation_threshold)
         if i < len(windows) and len(windows)>1:
             last_surface = this_surface.copy()
     return is_object_cell
 
 
+#%%
+
+'''
+Samples grid Z at fractional pixel coordinates r,c (as from ~t * (x,y), so 
+that cell centers are at r,c = i+.5,j+.5), for many points at once.  method
+is 'linear' (bilinear, from the 4 surrounding cells) or 'cubic' (Keys' cubic
+convolution, a=-0.5, from the 16 surrounding cells, which passes through the
+cell values like a cubic spline but needs no global fit).  Points beyond the
+outer cell centers take the edge values.  Points are evaluated chunk_size at
+a time, so memory is bounded however many there are.
+'''
+
+def sample_grid(Z,r,c,method='cubic',chunk_size=1000000):
+    r,c = np.asarray(r,dtype=np.float64),np.asarray(c,dtype=np.float64)
+    out = np.empty(np.shape(r))
+    r_flat,c_flat,out_flat = r.reshape(-1),c.reshape(-1),out.reshape(-1)
+    Z_flat = np.ascontiguousarray(Z,dtype=np.float64).reshape(-1)
+    for start in range(0,len(r_flat),chunk_size):
+        rows = _sample_weights(r_flat[start:start+chunk_size] - .5,Z.shape[0],method)
+        cols = _sample_weights(c_flat[start:start+chunk_size] - .5,Z.shape[1],method)
+        total = np.zeros(len(rows[0][0]))
+        for i,wr in rows:
+            i = i * Z.shape[1]
+            row_total = np.zeros(len(total))
+            for j,wc in cols:
+                row_total += wc * Z_flat.take(i + j)
+            total += wr * row_total
+        out_flat[start:start+chunk_size] = total
+    return out
+
+
+# The neighboring indices (clamped to the grid) and weights along one axis,
+# for positions x in cell index units
+def _sample_weights(x,n,method='cubic'):
+    x = np.clip(x,0,n-1)
+    i = np.minimum(np.floor(x).astype(np.int64),n-1)
+    f = x - i
+    if method=='linear':
+        offsets,weights = (0,1),(1-f,f)
+    elif method=='cubic':
+        offsets = (-1,0,1,2)
+        weights = (((-.5*f + 1)*f - .5)*f,
+                   (1.5*f - 2.5)*f*f + 1,
+                   ((-1.5*f + 2)*f + .5)*f,
+                   (.5*f - .5)*f*f)
+    else:
+        raise ValueError('Method ' + str(method) + ' not supported.')
+    return [(np.clip(i+offset,0,n-1),weight) for offset,weight in zip(offsets,weights)]
+
+
 #%%
 
 '''
@@ -1215,23 +2912,24 @@ value to avoid its use entirely.  A second parameter (low_outlier_fill) will
 remove the points from the provisional DTM, and then fill them in before the main
 body of the SMRF algorithm proceeds.  This should aid in preventing the "damage"
 to the DTM that can happen when low outliers are present.
+
+The provisional surface and its slope are sampled at each point with 
+sample_grid, by Keys' cubic convolution (interpolation='cubic') or bilinearly
+('linear'), which is linear in the number of points.  interpolation='spline'
+instead fits a RectBivariateSpline to the whole grid, as earlier versions did.
+
+n_jobs is passed on to create_dem to grid the minimum surface in parallel.
 '''
 
 def smrf(x,y,z,cellsize=1,windows=18,slope_threshold=.15,elevation_threshold=.5,
-         elevation_scaler=1.25,low_filter_slope=5,low_outlier_fill=False):
+         elevation_scaler=1.25,low_filter_slope=5,low_outlier_fill=False,n_jobs=1,
+         interpolation='cubic'):
 
     if np.isscalar(windows):
         windows = np.arange(windows) + 1
     
-    Zmin,t = create_dem(x,y,z,cellsize=cellsize,bin_type='min');
-    is_empty_cell = np.isnan(Zmin)
-    Zmin = inpaint_nans_by_springs(Zmin)
-    low_outliers = progressive_filter(-Zmin,np.array([1]),cellsize,slope_threshold=low_filter_slope); 
-    
-    # perhaps best to remove and interpolate those low values before proceeding?
-    if low_outlier_fill:
-        Zmin[low_outliers] = np.nan
-        Zmin = inpaint_nans_by_springs(Zmin)
+    Zmin,t,is_empty_cell,low_outliers = _smrf_minimum_surface(x,y,z,cellsize,low_filter_slope,
+                                                              low_outlier_fill,n_jobs)
     
     # This is the main crux of the algorithm
     object_cells = progressive_filter(Zmin,windows,cellsize,slope_threshold);
@@ -1245,36 +2943,9 @@ def smrf(x,y,z,cellsize=1,windows=18,slope_threshold=.15,elevation_threshold=.5,
     Zpro[object_cells] = np.nan
     Zpro = inpaint_nans_by_springs(Zpro)
     
-    # Use provisional surface to interpolate a height at each x,y point in the
-    # point cloud.  This uses a linear interpolator, where the original SMRF
-    # used a splined cubic interpolator.  Perhaps use RectBivariateSpline instead.
-    col_centers = np.arange(0.5,Zpro.shape[1]+.5)
-    row_centers = np.arange(0.5,Zpro.shape[0]+.5)
-    
-    # Regular Grid Interpolator, keep here for a reference for a short time
-    # Example syntax: x,y = t * (col,row)
-#    xi, _ = t * (col_centers, np.zeros(np.shape(col_centers)))
-#    _, yi = t * (np.zeros(np.shape(row_centers)), row_centers)
-#    f1 = interpolate.RegularGridInterpolator((yi[::-1],xi),np.flipud(Zpro))
-#    elevation_values = f1((y,x))
-    
-    # RectBivariateSpline Interpolator
-    c,r = ~t * (x,y)
-    f1 = interpolate.RectBivariateSpline(row_centers,col_centers,Zpro)
-    elevation_values = f1.ev(r,c)
-    
-    # Calculate a slope value for each point.  This is used to apply a some "slop"
-    # to the ground/object ID, since there is more uncertainty on slopes than on
-    # flat areas.
-    gy,gx = np.gradient(Zpro,cellsize)
-    S = np.sqrt(gy**2 + gx**2)
-    del gy,gx
-    f2 = interpolate.RectBivariateSpline(row_centers,col_centers,S)
-    del S
-    slope_values = f2.ev(r,c)
-    
     # Use elevation and slope values and thresholds interpolated from the 
     # provisional surface to classify as object/ground
+    elevation_values,slope_values = _smrf_sample(Zpro,t,x,y,cellsize,interpolation)
     required_value = elevation_threshold + (elevation_scaler * slope_values)
     is_object_point = np.abs(elevation_values - z) > required_value
     
@@ -1283,6 +2954,334 @@ def smrf(x,y,z,cellsize=1,windows=18,slope_threshold=.15,elevation_threshold=.5,
     return Zpro,t,object_cells,is_object_point
 
 
+#%%
+
+'''
+Runs SMRF over a project too large to hold in memory, tile by tile.  files 
+is a LasCatalog, or anything LasCatalog accepts (a directory, glob pattern 
+or list of las/laz files).  The project is cut into tiles of tile_size x 
+tile_size cells, aligned to one grid across the project, and each tile is 
+read with a buffer of the largest window (times cellsize) on every side, so 
+that the filter sees the same neighborhood as it would over the whole 
+project.  Only the tile's own (core) points and cells are kept, each point 
+belonging to exactly one tile.
+
+Points are written to out_las with their class set to ground_class or 
+object_class, and the provisional DTM to the GeoTIFF out_dtm, as each tile
+finishes, so memory is bounded by a tile (plus buffer) per worker.  DTM 
+cells beyond the reach of a tile's points (e.g. at project corners) are left
+as nodata.  Tiles 
+run on n_jobs worker processes (or threads, if use_processes is False); 
+scripts should guard their entry point with if __name__ == '__main__'.  
+Other keyword arguments are passed on to smrf.
+
+Returns a dataframe with the row and column offsets, number of points and 
+number of ground points of each tile.
+
+Example:
+    if __name__ == '__main__':
+        neilpy.smrf_tiles('project/','ground.laz','dtm.tif',cellsize=1,windows=18,n_jobs=8)
+'''
+
+def smrf_tiles(files,out_las=None,out_dtm=None,tile_size=1000,cellsize=1,windows=18,
+               n_jobs=None,use_processes=True,ground_class=2,object_class=1,**kwargs):
+    catalog = files if isinstance(files,LasCatalog) else LasCatalog(files)
+    if len(catalog)==0:
+        raise ValueError('No point files found.')
+    buffer = int(np.max(windows))
+    t,shape = _grid_definition(*catalog.bounds,cellsize)
+    
+    tiles = []
+    for r0 in range(0,shape[0],tile_size):
+        for c0 in range(0,shape[1],tile_size):
+            r1,c1 = min(r0+tile_size,shape[0]),min(c0+tile_size,shape[1])
+            xmin,ymax = t * (c0,r0)
+            xmax,ymin = t * (c1,r1)
+            if len(catalog.intersects((xmin,ymin,xmax,ymax))):
+                tiles.append((catalog,t,(r0,r1,c0,c1),cellsize,windows,buffer,
+                              out_las is not None,kwargs))
+    
+    writer,dtm = None,None
+    if out_las is not None:
+        header = read_las_header(catalog.index.filename.iloc[0])
+        if catalog.index.point_data_format_id.nunique() > 1:
+            raise ValueError('All files must share one point data format.')
+        writer = LasWriter(out_las,header)
+    if out_dtm is not None:
+        epsg = catalog.index.epsg.dropna()
+        profile = {'width':shape[1],'height':shape[0],'transform':t,'nodata':np.nan,
+                   'crs':rasterio.crs.CRS.from_epsg(int(epsg.iloc[0])) if len(epsg) else None}
+        profile = _geotiff_profile(profile,np.float32,1)
+        profile['BIGTIFF'] = 'IF_SAFER'
+        dtm = rasterio.open(out_dtm,'w',**profile)
+    
+    summary = []
+    try:
+        with _executor(n_jobs,use_processes) as executor:
+            # Keep only a few tiles in flight, so finished tiles don't pile up
+            pending = []
+            tiles = iter(tiles)
+            while True:
+                while len(pending) < 2*(n_jobs or os.cpu_count() or 1):
+                    args = next(tiles,None)
+                    if args is None:
+                        break
+                    pending.append((args[2],executor.submit(_smrf_tile,args)))
+                if not pending:
+                    break
+                (r0,r1,c0,c1),future = pending.pop(0)
+                points,is_object_point,Zpro = future.result()
+                if writer is not None and len(points):
+                    classes = np.where(is_object_point,object_class,ground_class)
+                    if catalog.index.point_data_format_id.iloc[0] < 6:
+                        classes = (points['class'].values & 224) | classes
+                    points['class'] = classes
+                    writer.write(points)
+                if dtm is not None:
+                    dtm.write(Zpro.astype(np.float32),1,
+                              window=rasterio.windows.Window(c0,r0,c1-c0,r1-r0))
+                summary.append({'row_off':r0,'col_off':c0,'num_points':len(is_object_point),
+                                'num_ground':int(np.sum(~is_object_point))})
+    finally:
+        if writer is not None:
+            writer.close()
+        if dtm is not None:
+            dtm.close()
+    return pd.DataFrame(summary,columns=['row_off','col_off','num_points','num_ground'])
+
+
+# Runs SMRF on one buffered tile for smrf_tiles, returning the core points
+# (all columns if needed for writing), their classification, and the core of
+# the provisional surface
+def _smrf_tile(args):
+    catalog,t,(r0,r1,c0,c1),cellsize,windows,buffer,all_columns,kwargs = args
+    xmin,ymax = t * (c0-buffer,r0-buffer)
+    xmax,ymin = t * (c1+buffer,r1+buffer)
+    columns = None if all_columns else ['x','y','z']
+    df = catalog.read(bbox=(xmin,ymin,xmax,ymax),columns=columns,n_jobs=1)
+    Zcore = np.full((r1-r0,c1-c0),np.nan)
+    if len(df)==0:
+        return df,np.zeros(0,dtype=bool),Zcore
+    Zpro,t_tile,object_cells,is_object_point = smrf(df.x.values,df.y.values,df.z.values,
+                                                    cellsize=cellsize,windows=windows,**kwargs)
+    
+    # Both grids center cells on multiples of cellsize, so differ by whole cells
+    c,r = ~t * (df.x.values,df.y.values)
+    c,r = np.floor(c),np.floor(r)
+    core = (r>=r0) & (r<r1) & (c>=c0) & (c<c1)
+    col_off,row_off = np.round(~t * (t_tile.c,t_tile.f)).astype(int)
+    top,bottom = max(r0,row_off),min(r1,row_off+Zpro.shape[0])
+    left,right = max(c0,col_off),min(c1,col_off+Zpro.shape[1])
+    if bottom > top and right > left:
+        Zcore[top-r0:bottom-r0,left-c0:right-c0] = Zpro[top-row_off:bottom-row_off,
+                                                        left-col_off:right-col_off]
+    return df[core].reset_index(drop=True),is_object_point[core],Zcore
+
+
+# The minimum surface SMRF starts from, with empty cells and low outliers
+# (found by filtering the inverted surface) inpainted
+def _smrf_minimum_surface(x,y,z,cellsize=1,low_filter_slope=5,low_outlier_fill=False,n_jobs=1):
+    Zmin,t = create_dem(x,y,z,cellsize=cellsize,bin_type='min',n_jobs=n_jobs);
+    is_empty_cell = np.isnan(Zmin)
+    Zmin = inpaint_nans_by_springs(Zmin)
+    low_outliers = progressive_filter(-Zmin,np.array([1]),cellsize,slope_threshold=low_filter_slope); 
+    
+    # perhaps best to remove and interpolate those low values before proceeding?
+    if low_outlier_fill:
+        Zmin[low_outliers] = np.nan
+        Zmin = inpaint_nans_by_springs(Zmin)
+    return Zmin,t,is_empty_cell,low_outliers
+
+
+# Use provisional surface to interpolate a height at each x,y point in the
+# point cloud, and a slope value for each point.  The slope is used to 
+# apply a some "slop" to the ground/object ID, since there is more 
+# uncertainty on slopes than on flat areas.
+def _smrf_sample(Zpro,t,x,y,cellsize=1,interpolation='cubic'):
+    c,r = ~t * (x,y)
+    gy,gx = np.gradient(Zpro,cellsize)
+    S = np.sqrt(gy**2 + gx**2)
+    del gy,gx
+    if interpolation=='spline':
+        col_centers = np.arange(0.5,Zpro.shape[1]+.5)
+        row_centers = np.arange(0.5,Zpro.shape[0]+.5)
+        f1 = interpolate.RectBivariateSpline(row_centers,col_centers,Zpro)
+        elevation_values = f1.ev(r,c)
+        f2 = interpolate.RectBivariateSpline(row_centers,col_centers,S)
+        slope_values = f2.ev(r,c)
+    else:
+        elevation_values = sample_grid(Zpro,r,c,interpolation)
+        slope_values = sample_grid(S,r,c,interpolation)
+    return elevation_values,slope_values
+
+
+#%%
+
+'''
+Classification error rates of is_object_point against the truth (both 
+boolean, True for object points, as in the fourth column of the ISPRS 
+reference samples in sample_data): 
+    type_i: the proportion of ground points classified as object
+    type_ii: the proportion of object points classified as ground
+    total: the proportion of all points misclassified
+'''
+
+def classification_errors(is_object_point,truth):
+    is_object_point,truth = np.asarray(is_object_point,dtype=bool),np.asarray(truth,dtype=bool)
+    with np.errstate(invalid='ignore',divide='ignore'):
+        return {'type_i':np.sum(is_object_point & ~truth) / np.sum(~truth),
+                'type_ii':np.sum(~is_object_point & truth) / np.sum(truth),
+                'total':np.mean(is_object_point != truth)}
+
+
+'''
+Evaluates SMRF over every combination of windows, slope_thresholds, 
+elevation_thresholds and elevation_scalers (each a list; an entry of windows
+may be a scalar or an array, as in smrf), computing the shared steps once:
+    The minimum surface, its inpainting and the low outliers are computed 
+    once for all combinations.
+    The openings of the progressive filter depend only on the windows, so 
+    one pass over the largest scalar window serves every scalar window and
+    every slope threshold: a cell is an object cell when its largest drop 
+    under an opening, relative to the window's elevation threshold, 
+    exceeds the slope threshold.
+    The provisional surface is inpainted and sampled once per window and 
+    slope threshold, and all elevation thresholds and scalers are compared 
+    against it at once.
+Other arguments are as in smrf.  Returns a dataframe with a row per 
+combination giving, if truth (True for object points) is supplied, the 
+type_i, type_ii and total errors of classification_errors, and otherwise the
+proportion of points classified as ground.
+
+Example:
+    df = pd.read_csv('sample_data/samp11.txt',sep='\t',header=None,names=['x','y','z','g'])
+    errors = neilpy.smrf_sweep(df.x,df.y,df.z,df.g==1,windows=[6,12,18],
+                               slope_thresholds=[.1,.15,.2],
+                               elevation_thresholds=[.25,.5,.75],
+                               elevation_scalers=[0,.5,1.25])
+    errors.sort_values('total').head()
+'''
+
+def smrf_sweep(x,y,z,truth=None,cellsize=1,windows=[18],slope_thresholds=[.15],
+               elevation_thresholds=[.5],elevation_scalers=[1.25],low_filter_slope=5,
+               low_outlier_fill=False,n_jobs=1,interpolation='cubic'):
+    x,y,z = np.asarray(x),np.asarray(y),np.asarray(z)
+    Zmin,t,is_empty_cell,low_outliers = _smrf_minimum_surface(x,y,z,cellsize,low_filter_slope,
+                                                              low_outlier_fill,n_jobs)
+    
+    # The largest ratio of drop to window size, by window
+    ratios = {}
+    scalar_windows = [int(w) for w in windows if np.isscalar(w)]
+    if len(scalar_windows):
+        for w,ratio in zip(range(1,max(scalar_windows)+1),
+                           _progressive_ratios(Zmin,np.arange(max(scalar_windows))+1,cellsize)):
+            if w in scalar_windows:
+                ratios[w] = ratio.copy()
+    for w in windows:
+        if not np.isscalar(w):
+            for ratio in _progressive_ratios(Zmin,np.asarray(w),cellsize):
+                pass
+            ratios[tuple(w)] = ratio
+    
+    thresholds,scalers = np.meshgrid(elevation_thresholds,elevation_scalers,indexing='ij')
+    thresholds,scalers = thresholds.ravel(),scalers.ravel()
+    results = []
+    for w in windows:
+        ratio = ratios[w if np.isscalar(w) else tuple(w)]
+        for slope_threshold in slope_thresholds:
+            Zpro = Zmin.copy()
+            Zpro[is_empty_cell | low_outliers | (ratio > slope_threshold)] = np.nan
+            Zpro = inpaint_nans_by_springs(Zpro)
+            elevation_values,slope_values = _smrf_sample(Zpro,t,x,y,cellsize,interpolation)
+            difference = np.abs(elevation_values - z)
+            for threshold,scaler in zip(thresholds,scalers):
+                is_object_point = difference > threshold + scaler * slope_values
+                result = {'windows':w,'slope_threshold':slope_threshold,
+                          'elevation_threshold':threshold,'elevation_scaler':scaler}
+                if truth is None:
+                    result['ground'] = np.mean(~is_object_point)
+                else:
+                    result.update(classification_errors(is_object_point,truth))
+                results.append(result)
+    return pd.DataFrame(results)
+
+
+# Yields, after each window of the progressive filter, the largest ratio so
+# far of each cell's drop under the opening to the window size (windows * 
+# cellsize); a cell is an object cell in progressive_filter when this 
+# exceeds the slope threshold.
+def _progressive_ratios(Z,windows,cellsize=1):
+    last_surface = Z.copy()
+    ratio = np.full(np.shape(Z),-np.inf)
+    for window in windows:
+        this_surface = disk_opening(last_surface,window)
+        np.maximum(ratio,(last_surface - this_surface) / (window * cellsize),out=ratio)
+        last_surface = this_surface
+        yield ratio
+
+
+#%%
+
+'''
+Benchmarks smrf on the ISPRS filter test samples bundled in sample_data 
+(samp11.txt ... samp71.txt: x, y, z, and 1 for object points), for checking
+that performance work keeps both speed and accuracy.  For each sample this 
+records the number of points, wall time, points per second, peak memory 
+allocated during the run (traced with tracemalloc), and the Type I, Type II
+and total errors of classification_errors.  Keyword arguments are passed on 
+to smrf; samples limits the run to those names (e.g. ['samp11','samp52']).
+
+baseline, a dataframe or CSV file from an earlier run, adds each sample's 
+baseline time, memory and total error, with the speedup, memory ratio and 
+change in total error.  save writes the results to a CSV file, to serve as 
+a later baseline.
+
+Example:
+    neilpy.benchmark_smrf(save='smrf_baseline.csv')
+    # ... change things ...
+    results = neilpy.benchmark_smrf(baseline='smrf_baseline.csv')
+    print(results[['sample','speedup','total_change']])
+'''
+
+def benchmark_smrf(sample_dir=None,baseline=None,save=None,samples=None,**kwargs):
+    if sample_dir is None:
+        sample_dir = os.path.join(neilpy_dir,'..','sample_data')
+    files = sorted(glob.glob(os.path.join(sample_dir,'samp*.txt')))
+    if samples is not None:
+        files = [fn for fn in files if os.path.splitext(os.path.basename(fn))[0] in samples]
+    if len(files)==0:
+        raise ValueError('No samples found in ' + sample_dir)
+    
+    results = []
+    for fn in files:
+        df = pd.read_csv(fn,header=None,names=['x','y','z','g'],delimiter='\t')
+        x,y,z = df.x.values,df.y.values,df.z.values
+        tracemalloc.start()
+        then = time.perf_counter()
+        is_object_point = smrf(x,y,z,**kwargs)[3]
+        seconds = time.perf_counter() - then
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        result = {'sample':os.path.splitext(os.path.basename(fn))[0],'points':len(df),
+                  'seconds':seconds,'points_per_second':len(df) / seconds,
+                  'peak_memory_mb':peak / 2**20}
+        result.update(classification_errors(is_object_point,df.g.values==1))
+        results.append(result)
+    results = pd.DataFrame(results)
+    
+    if baseline is not None:
+        if not isinstance(baseline,pd.DataFrame):
+            baseline = pd.read_csv(baseline)
+        baseline = baseline[['sample','seconds','peak_memory_mb','total']]
+        results = results.merge(baseline,on='sample',how='left',suffixes=('','_baseline'))
+        results['speedup'] = results.seconds_baseline / results.seconds
+        results['memory_ratio'] = results.peak_memory_mb / results.peak_memory_mb_baseline
+        results['total_change'] = results.total - results.total_baseline
+    if save is not None:
+        results.to_csv(save,index=False)
+    return results
+
+
 #%%
 '''
 h0 is the height of the neighbor pixel in one direction, relative to the center
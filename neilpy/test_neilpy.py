@@ -59,25 +59,14 @@ im.save('../neilpy_data/poland_30m_geomorphons.png')
 write_worldfile(Zt,'../neilpy_data/poland_30m_geomorphons.pgw')
 
 #%%  SMRF TESTING
-fns = glob.glob(r'C:\Temp\Reference\*.txt')
-total_error = np.zeros(len(fns))
-for i,fn in enumerate(fns):
-    df = pd.read_csv(fn,header=None,names=['x','y','z','g'],delimiter='\t')
-    x,y,z = df.x.values,df.y.values,df.z.values
-    windows = np.arange(18) + 1
-    cellsize= 1
-    slope_threshold = .15
-    elevation_threshold = .5
-    elevation_scaler = 1.25
-    
-    result = neilpy.smrf(x,y,z,windows,cellsize,slope_threshold,elevation_threshold,elevation_scaler)
-    
-    total_error[i] = 1 - np.sum(result[3] == df.g) / len(df)
-    
-    print(fn,':',total_error[i])
-
-print('Mean total error',np.mean(total_error))
-print('Median total error',np.median(total_error))
+# Runs over the ISPRS samples in sample_data; pass baseline= a saved run to 
+# compare speed and accuracy
+results = neilpy.benchmark_smrf(cellsize=1,windows=18,slope_threshold=.15,
+                                elevation_threshold=.5,elevation_scaler=1.25)
+print(results)
+
+print('Mean total error',results.total.mean())
+print('Median total error',results.total.median())
 
 #%%
 plt.imshow(Zpro)